@@ -7,6 +7,10 @@
 import sys
 import gzip
 import re
+import multiprocessing
+import collections
+
+CHUNK = 100000  # minimum lines per chunk
 
 def openRead(filename):
   '''
@@ -42,9 +46,10 @@ def openWrite(filename):
     sys.exit(-1)
   return f
 
-def printDiff(f, read, seq1, seq2):
+def printDiff(res, read, seq1, seq2, summ):
   '''
-  Print differences between two seqs.
+  Save differences between two seqs (as output lines) to res.
+    If summ is given, tally them there instead.
   '''
   # determine length of leading/trailing gaps ('---')
   leadGap = 0
@@ -53,19 +58,31 @@ def printDiff(f, read, seq1, seq2):
   tailGap = min(len(seq1), len(seq2)) - 1
   while seq1[tailGap] == '-' or seq2[tailGap] == '-':
     tailGap -= 1
+  if summ != None:
+    counts, lens = summ
+    lens[tailGap - leadGap + 1] += 1
+    for j in xrange(leadGap, tailGap + 1):
+      if seq1[j] != seq2[j] and seq1[j] != ' ' and seq2[j] != ' ':
+        counts[(j - leadGap, seq1[j], seq2[j])] += 1
+    return
   for j in xrange(leadGap, tailGap + 1):
     if seq1[j] != seq2[j] and seq1[j] != ' ' and seq2[j] != ' ':
-      f.write('\t'.join([read, str(j - leadGap), seq1[j], '!', seq2[j], '!']) + '\n')
+      res.append('\t'.join([read, str(j - leadGap), seq1[j], '!', seq2[j], '!']) + '\n')
 
-def parseFile(fIn, fOut):
+def parseChunk(chunk, matrix):
   '''
-  Produce list of mismatches from SeqPrep alignment file.
+  Produce mismatches from a chunk of a SeqPrep alignment file
+    (beginning at an 'ID:' record). Return output, tallies
+    (if matrix), and count.
   '''
-  line = fIn.readline()
+  res = []
+  summ = None
+  if matrix:
+    summ = (collections.Counter(), collections.Counter())
   read = ''
   subj = quer = ''
   count = 0
-  while line:
+  for line in chunk.split('\n'):
     spl = line.rstrip()
     if spl[0:3] == 'ID:':
       read = spl[3:].lstrip().split(' ')[0]
@@ -75,27 +92,110 @@ def parseFile(fIn, fOut):
       subj = spl[7:]
     elif spl[0:5] == 'QUER:':
       quer = spl[6:]
-      printDiff(fOut, read, subj, quer)
+      printDiff(res, read, subj, quer, summ)
       read = subj = quer = ''
       count += 1
     elif spl[0:6] == 'READ2:':
       quer = spl[7:]
-      printDiff(fOut, read, subj, quer)
+      printDiff(res, read, subj, quer, summ)
       read = subj = quer = ''
       count += 1
-    line = fIn.readline()
+  return ''.join(res), summ, count
+
+def printSummary(fOut, counts, lens):
+  '''
+  Print matrix of mismatch counts: one row per position,
+    with the number of reads aligned there, and one column
+    per ref>query base pair.
+  '''
+  pairs = sorted(set([(k[1], k[2]) for k in counts]))
+  fOut.write('\t'.join(['pos', 'reads'] \
+    + [a + '>' + b for a, b in pairs]) + '\n')
+  reads = sum(lens.values())
+  for pos in xrange(max(lens) if lens else 0):
+    reads -= lens[pos]
+    fOut.write('\t'.join([str(pos), str(reads)] \
+      + [str(counts[(pos, a, b)]) for a, b in pairs]) + '\n')
+
+def readChunks(fIn):
+  '''
+  Generate chunks of the input file (of at least CHUNK
+    lines), split at 'ID:' record boundaries.
+  '''
+  chunk = []
+  for line in fIn:
+    if len(chunk) >= CHUNK and line[0:3] == 'ID:':
+      yield ''.join(chunk)
+      chunk = []
+    chunk.append(line)
+  if chunk:
+    yield ''.join(chunk)
+
+def poolChunks(pool, procs, chunks, matrix):
+  '''
+  Generate results of chunks processed by the pool,
+    in input order, with at most 2*procs pending.
+  '''
+  pending = collections.deque()
+  for chunk in chunks:
+    pending.append(pool.apply_async(parseChunk, (chunk, matrix)))
+    if len(pending) > 2 * procs:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def parseFile(fIn, fOut, procs, matrix):
+  '''
+  Produce list of mismatches from SeqPrep alignment file
+    (or a summary matrix, if matrix). Chunks are processed
+    by a pool of worker processes if procs > 1, with output
+    written in input order.
+  '''
+  count = 0
+  counts = collections.Counter()  # (pos, ref, query) -> mismatches
+  lens = collections.Counter()    # aligned length -> reads
+  if procs < 2:
+    results = (parseChunk(chunk, matrix) for chunk in readChunks(fIn))
+  else:
+    pool = multiprocessing.Pool(procs)
+    results = poolChunks(pool, procs, readChunks(fIn), matrix)
+  for res, summ, num in results:
+    if matrix:
+      counts.update(summ[0])
+      lens.update(summ[1])
+    else:
+      fOut.write(res)
+    count += num
+  if procs >= 2:
+    pool.close()
+    pool.join()
+  if matrix:
+    printSummary(fOut, counts, lens)
   sys.stderr.write('Reads analyzed: %d\n' % count)
 
 def main():
   args = sys.argv[1:]
   if len(args) < 2:
-    sys.stderr.write('Usage: python SeqPrepDiff.py <in> <out>\n')
+    sys.stderr.write('Usage: python SeqPrepDiff.py <in> <out> ' \
+      + '[<procs>] [<format>]\n')
+    sys.stderr.write('  <procs>   Number of worker processes (def. 1)\n')
+    sys.stderr.write('  <format>  \'list\' of mismatches (def.), or \'matrix\'\n' \
+      + '              of mismatch counts by position and base pair\n')
     sys.exit(-1)
 
   # process file
   fIn = openRead(args[0])
   fOut = openWrite(args[1])
-  parseFile(fIn, fOut)
+  procs = 1
+  if len(args) > 2:
+    procs = int(args[2])
+  matrix = False
+  if len(args) > 3:
+    if args[3] not in ['list', 'matrix']:
+      sys.stderr.write('Error! Unknown output format: %s\n' % args[3])
+      sys.exit(-1)
+    matrix = args[3] == 'matrix'
+  parseFile(fIn, fOut, procs, matrix)
 
   if fIn != sys.stdin:
     fIn.close()
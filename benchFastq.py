@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+# Benchmark fastq parsing: four readline() calls per
+#   record vs. the block reader (readFastq) used by
+#   retrieveReads.py and mergeSplit.py.
+
+import sys
+import time
+from retrieveReads import openRead, readFastq
+
+def readLines(f):
+  '''
+  Parse fastq records with four readline() calls each,
+    saving the read name (as the scripts did previously).
+  '''
+  count = 0
+  flag = True
+  while flag:
+    for i in range(4):
+      line = f.readline()
+      if not line:
+        flag = False
+        break
+      if i == 0:
+        head = line.split(' ')[0][1:].rstrip()
+    if flag:
+      count += 1
+  return count
+
+def readBlocks(f):
+  '''
+  Parse fastq records with readFastq().
+  '''
+  count = 0
+  for name, head, seq, plus, qual in readFastq(f):
+    count += 1
+  return count
+
+def main():
+  '''Main.'''
+  args = sys.argv[1:]
+  if len(args) < 1:
+    sys.stderr.write('Usage: python %s  <fastq>  [<reps>]\n' % sys.argv[0])
+    sys.stderr.write('  <reps>   Number of repetitions (def. 3)\n')
+    sys.exit(-1)
+  reps = 3
+  if len(args) > 1:
+    reps = int(args[1])
+
+  for label, func in [('readline', readLines), ('readFastq', readBlocks)]:
+    best = -1
+    for i in range(reps):
+      f = openRead(args[0])
+      start = time.time()
+      count = func(f)
+      elapsed = time.time() - start
+      f.close()
+      if best == -1 or elapsed < best:
+        best = elapsed
+    sys.stderr.write('%-10s  reads: %d  best time: %.3fs\n' \
+      % (label, count, best))
+
+if __name__ == '__main__':
+  main()
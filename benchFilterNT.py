@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Benchmark filterNT's per-record checks on a fasta file
+#   (e.g. a full nt build): header exclusion with a list
+#   (previous) vs. a set vs. a HeaderSet, and the pure-N
+#   check per line (previous) vs. pureN().
+
+import sys
+import time
+from filterNT import openRead, readBlocks, loadHeaders, pureN
+
+def pureNLines(seq):
+  '''
+  Determine if a sequence (lines) is pure Ns, comparing
+    each line to a string of Ns (previous implementation).
+  '''
+  for line in seq.split('\n'):
+    if line.rstrip() != 'N' * len(line):
+      return False
+  return True
+
+def loadRecords(f):
+  '''
+  Load (header, sequence) of each fasta record.
+  '''
+  recs = []
+  for block in readBlocks(f):
+    for rec in block.split('\n>'):
+      head, seq = (rec + '\n').split('\n', 1)
+      recs.append((head.lstrip('>').rstrip().split(' ')[0], seq[:-1]))
+  return recs
+
+def timeFunc(func, reps):
+  '''
+  Return result and best time of reps calls to func.
+  '''
+  best = -1
+  for i in range(reps):
+    start = time.time()
+    res = func()
+    elapsed = time.time() - start
+    if best == -1 or elapsed < best:
+      best = elapsed
+  return res, best
+
+def main():
+  '''Main.'''
+  args = sys.argv[1:]
+  if len(args) < 2:
+    sys.stderr.write('Usage: python %s  <fasta>  <headers>  [<reps>]\n' \
+      % sys.argv[0])
+    sys.stderr.write('  <reps>   Number of repetitions (def. 3)\n')
+    sys.exit(-1)
+  reps = 3
+  if len(args) > 2:
+    reps = int(args[2])
+
+  f = openRead(args[0])
+  recs = loadRecords(f)
+  if f != sys.stdin:
+    f.close()
+  f = openRead(args[1])
+  heads = [line.rstrip() for line in f]
+  if f != sys.stdin:
+    f.close()
+  sys.stderr.write('Records: %d  headers: %d\n' % (len(recs), len(heads)))
+
+  # header exclusion
+  res = None
+  for label, headers in [('list', heads), \
+      ('set', loadHeaders(heads, False)), \
+      ('HeaderSet', loadHeaders(heads, True))]:
+    count, best = timeFunc(lambda: sum([1 for head, seq in recs \
+      if head in headers]), reps)
+    if res == None:
+      res = count
+    elif count != res:
+      sys.stderr.write('Error! %s results differ\n' % label)
+      sys.exit(-1)
+    sys.stderr.write('%-10s  excluded: %d  best time: %.3fs\n' \
+      % (label, count, best))
+
+  # pure-N check
+  res = None
+  for label, func in [('lines', pureNLines), ('pureN', pureN)]:
+    count, best = timeFunc(lambda: sum([1 for head, seq in recs \
+      if func(seq)]), reps)
+    if res == None:
+      res = count
+    elif count != res:
+      sys.stderr.write('Error! %s results differ\n' % label)
+      sys.exit(-1)
+    sys.stderr.write('%-10s  pure Ns: %d  best time: %.3fs\n' \
+      % (label, count, best))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+# Benchmark reverse-complementing: the previous character
+#   loop vs. revComp() (string.translate based, as in
+#   compareFastq2/3, countErrors8, findSeq, and
+#   subsetBAM/subsetBAM2).
+
+import sys
+import random
+import time
+from compareFastq3 import revComp
+
+def revCompLoop(dna):
+  '''
+  Reverse-complement the given DNA sequence, one
+    character at a time (previous implementation).
+  '''
+  rc = ''
+  for nuc in dna[::-1]:
+    comp = ''
+    if nuc == 'A': comp = 'T'
+    elif nuc == 'C': comp = 'G'
+    elif nuc == 'G': comp = 'C'
+    elif nuc == 'T': comp = 'A'
+    elif nuc == 'N': comp = 'N'
+    else:
+      print 'Error! Unknown nucleotide: %s' % nuc
+    rc += comp
+  return rc
+
+def main():
+  '''Main.'''
+  args = sys.argv[1:]
+  num = 100000  # number of sequences
+  length = 150  # length of sequences
+  if len(args) > 0:
+    num = int(args[0])
+  if len(args) > 1:
+    length = int(args[1])
+  if num < 1 or length < 1:
+    sys.stderr.write('Usage: python %s  [<num>]  [<len>]\n' % sys.argv[0])
+    sys.stderr.write('  <num>   Number of sequences (def. 100000)\n')
+    sys.stderr.write('  <len>   Length of sequences (def. 150)\n')
+    sys.exit(-1)
+
+  seqs = [''.join([random.choice('ACGTN') for i in xrange(length)]) \
+    for j in xrange(num)]
+
+  res = None
+  for label, func in [('loop', lambda s: [revCompLoop(x) for x in s]), \
+      ('revComp', lambda s: [revComp(x) for x in s])]:
+    start = time.time()
+    rc = func(seqs)
+    elapsed = time.time() - start
+    if res == None:
+      res = rc
+    elif rc != res:
+      sys.stderr.write('Error! %s results differ\n' % label)
+      sys.exit(-1)
+    sys.stderr.write('%-10s  seqs: %d x %dbp  time: %.3fs\n' \
+      % (label, num, length, elapsed))
+
+if __name__ == '__main__':
+  main()
@@ -5,7 +5,17 @@
 # Producing a summary from centrifuge's kraken-style report.
 
 import sys
+import os
 import gzip
+import zlib
+import mmap
+import struct
+import array
+
+CACHE = '.cache'  # suffix of compiled taxonomy cache (<taxTree>.cache)
+MAGIC = 'CSTAX01\n'
+HEAD = struct.Struct('<8sdqIi')  # magic, source mtime, size, crc32, entries
+ENTRY = struct.Struct('<i')      # canonical parent of each taxon (0 if none)
 
 def openRead(filename):
   '''
@@ -161,13 +171,15 @@ def loadScores(f, d):
 
 def findParent(d, taxon):
   '''
-  Find parent taxon (recursively).
+  Find parent taxon (walking up the tree iteratively).
   '''
-  if taxon not in d or d[taxon][0] not in d:
-    return None
-  if d[ d[taxon][0] ][1]:
-    return d[taxon][0]
-  return findParent(d, d[taxon][0])
+  for i in xrange(len(d)):
+    if taxon not in d or d[taxon][0] not in d:
+      return None
+    if d[ d[taxon][0] ][1]:
+      return d[taxon][0]
+    taxon = d[taxon][0]
+  return None  # cycle in tree
 
 def loadTax(f):
   '''
@@ -205,6 +217,132 @@ def loadTax(f):
 
   return d
 
+class TaxCache(object):
+  '''
+  TaxCache: canonical parent taxa, looked up (like the
+    dict from loadTax()) in a memory-mapped cache file
+    of parents indexed by taxon.
+  '''
+  __slots__ = ['mm', 'num']
+
+  def __init__(self, mm, num):
+    self.mm = mm
+    self.num = num
+
+  def get(self, taxon, default=None):
+    try:
+      t = int(taxon)
+    except ValueError:
+      return default
+    if t < 0 or t >= self.num:
+      return default
+    parent = ENTRY.unpack_from(self.mm, HEAD.size + ENTRY.size * t)[0]
+    return str(parent) if parent else default
+
+  def __contains__(self, taxon):
+    return self.get(taxon) != None
+
+  def __getitem__(self, taxon):
+    parent = self.get(taxon)
+    if parent == None:
+      raise KeyError(taxon)
+    return parent
+
+def checksum(filename):
+  '''
+  Calculate the CRC-32 of a file.
+  '''
+  crc = 0
+  f = open(filename, 'rb')
+  while True:
+    block = f.read(1048576)
+    if not block:
+      break
+    crc = zlib.crc32(block, crc)
+  f.close()
+  return crc & 0xffffffff
+
+def saveCache(d, filename):
+  '''
+  Write canonical parent taxa to the cache file, stamped
+    with the tree file's mtime, size, and checksum.
+    Return False if the taxa are not all numeric.
+  '''
+  try:
+    taxa = [(int(taxon), int(d[taxon])) for taxon in d]
+  except ValueError:
+    return False
+  num = max([t for t, parent in taxa] + [0]) + 1
+  arr = array.array('i', [0]) * num
+  for t, parent in taxa:
+    arr[t] = parent
+
+  st = os.stat(filename)
+  temp = filename + CACHE + '.tmp'
+  try:
+    f = open(temp, 'wb')
+    f.write(HEAD.pack(MAGIC, st.st_mtime, st.st_size, checksum(filename), \
+      num))
+    arr.tofile(f)
+    f.close()
+    os.rename(temp, filename + CACHE)
+  except (IOError, OSError):
+    sys.stderr.write('Warning! Cannot write taxonomy cache %s\n' \
+      % (filename + CACHE))
+  return True
+
+def loadCache(filename):
+  '''
+  Memory-map the cache file for a tree file. Return None
+    if it is missing or stale (tree file's size or checksum
+    changed; checksum verified only if mtime changed, after
+    which the header is restamped with the new mtime).
+  '''
+  try:
+    f = open(filename + CACHE, 'rb')
+    st = os.stat(filename)
+  except (IOError, OSError):
+    return None
+  head = f.read(HEAD.size)
+  if len(head) != HEAD.size:
+    f.close()
+    return None
+  magic, mtime, size, crc, num = HEAD.unpack(head)
+  if magic != MAGIC or size != st.st_size \
+      or os.path.getsize(filename + CACHE) != HEAD.size + ENTRY.size * num \
+      or (mtime != st.st_mtime and crc != checksum(filename)):
+    f.close()
+    return None
+  if mtime != st.st_mtime:
+    # checksum matches: restamp header with new mtime
+    try:
+      fHead = open(filename + CACHE, 'r+b')
+      fHead.write(HEAD.pack(MAGIC, st.st_mtime, size, crc, num))
+      fHead.close()
+    except IOError:
+      pass  # cache still valid (checksum verified each run)
+  mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  f.close()
+  return TaxCache(mm, num)
+
+def loadTree(filename):
+  '''
+  Load canonical parent taxa from the compiled cache of the
+    tree file, or parse the tree file (and compile the cache).
+  '''
+  if filename != '-':
+    d = loadCache(filename)
+    if d != None:
+      return d
+
+  fTax = openRead(filename)
+  d = loadTax(fTax)
+  if fTax != sys.stdin:
+    fTax.close()
+    if not saveCache(d, filename):
+      sys.stderr.write('Warning! Cannot cache non-numeric taxa\n')
+  return d
+
 def main():
   '''Main.'''
   args = sys.argv[1:]
@@ -214,11 +352,8 @@ def main():
       + '  <num>    Number of taxa to print (def. 20)\n')
     sys.exit(-1)
 
-  # load tax tree
-  fTax = openRead(args[1])
-  d = loadTax(fTax)
-  if fTax != sys.stdin:
-    fTax.close()
+  # load tax tree (compiled cache, if available)
+  d = loadTree(args[1])
 
   # load scores and create taxonomic tree
   fIn = openRead(args[0])
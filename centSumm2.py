@@ -6,7 +6,19 @@
 #   centrifuge's kraken-style report.
 
 import sys
+import os
 import gzip
+import zlib
+import mmap
+import struct
+import array
+import heapq
+import multiprocessing
+
+CACHE = '.cache'  # suffix of compiled taxonomy cache (<taxTree>.cache)
+MAGIC = 'CSTAX01\n'
+HEAD = struct.Struct('<8sdqIi')  # magic, source mtime, size, crc32, entries
+ENTRY = struct.Struct('<i')      # canonical parent of each taxon (0 if none)
 
 def openRead(filename):
   '''
@@ -42,13 +54,17 @@ def openWrite(filename):
     sys.exit(-1)
   return f
 
-class Node:
+class Node(object):
   '''
   Node: contains taxon name, taxon number,
     list of child nodes, parent node,
     score (percent of the sample), and
-    count (number of reads).
+    count (number of reads), and max count
+    in its subtree (see findMax()).
   '''
+  __slots__ = ['child', 'parent', 'name', 'taxon', 'score', 'count', \
+    'best']
+
   def __init__(self, parent, name, taxon, score, count):
     self.child = []
     self.parent = parent
@@ -56,6 +72,7 @@ class Node:
     self.taxon = taxon
     self.score = float(score)
     self.count = int(count)
+    self.best = self.count
 
 def printFooter(f, num, version, date):
   '''
@@ -106,23 +123,45 @@ def printFooter(f, num, version, date):
 <a href="mailto:jgaspar@fas.harvard.edu">Please let us know.</a></p>
 ''')
 
+def findMax(root):
+  '''
+  Save the max count in each node's subtree
+    (bottom-up, iteratively).
+  '''
+  order = []  # nodes, parents before children
+  stack = [root]
+  while stack:
+    n = stack.pop()
+    order.append(n)
+    stack.extend(n.child)
+  for n in reversed(order):
+    n.best = n.count
+    for m in n.child:
+      if m.best > n.best:
+        n.best = m.best
+
 def printLevel(f, n, level, cutoff):
   '''
   Print results for a node (if its count meets cutoff).
-    Continue printing for children nodes (recursively).
+    Continue printing for children nodes (iteratively),
+    skipping subtrees whose max count is below cutoff.
   '''
-  if n.count >= cutoff:  # or level == 0: # to include all children of root
-    f.write('  <tr>\n' \
-      + '    <td align="right">%.2f&emsp;</td>\n' % n.score \
-      + '    <td>%s%s</td>\n' % (level * 2 * '&emsp;', n.name) \
-      + '  </tr>\n')
-  for m in n.child:
-    printLevel(f, m, level + 1, cutoff)
+  stack = [(n, level)]
+  while stack:
+    n, level = stack.pop()
+    if n.count >= cutoff:  # or level == 0: # to include all children of root
+      f.write('  <tr>\n' \
+        + '    <td align="right">%.2f&emsp;</td>\n' % n.score \
+        + '    <td>%s%s</td>\n' % (level * 2 * '&emsp;', n.name) \
+        + '  </tr>\n')
+    for m in reversed(n.child):
+      if m.best >= cutoff:
+        stack.append((m, level + 1))
 
 def printOutput(f, unclass, root, num, cutoff, version, date):
   '''
   Begin printing results (header and unclassified).
-    Start recursive tree printing.
+    Start tree printing.
   '''
   f.write('''<h2>Taxonomy Analysis</h2>
 <strong><font color="red" size="4">Warning:</font></strong>
@@ -140,8 +179,10 @@ def printOutput(f, unclass, root, num, cutoff, version, date):
     + '  </tr>\n')
 
   # print tree
+  findMax(root)
   for n in root.child:
-    printLevel(f, n, 0, cutoff)
+    if n.best >= cutoff:
+      printLevel(f, n, 0, cutoff)
   f.write('</table>\n')
 
   printFooter(f, num, version, date)
@@ -152,20 +193,9 @@ def findCutoff(score, x):
   '''
   if x >= len(score):
     return 0
-  res = sorted(score, reverse=True)
-  return res[x-1]
-
-def checkTree(node, taxon):
-  '''
-  Search node and its children for given taxon.
-  '''
-  if node.taxon == taxon:
-    return node
-  for n in node.child:
-    parent = checkTree(n, taxon)
-    if parent:
-      return parent
-  return None
+  if x < 1:
+    return min(score)
+  return heapq.nlargest(x, score)[-1]
 
 def loadScores(f, d):
   '''
@@ -175,7 +205,7 @@ def loadScores(f, d):
   rank = 'DKPCOFGS'
   unclass = 0.0  # 'unclassified' score
   root = Node(None, 'root', '1', -1, -1) # root of tree
-  temp = root    # pointer to previous node
+  nodes = {'1': root}  # taxon -> node in tree
   score = []     # list of scores (read counts)
 
   for line in f:
@@ -204,16 +234,7 @@ def loadScores(f, d):
     if spl[4] not in d:
       sys.stderr.write('Warning! Unknown taxon: %s\n' % spl[4])
       continue
-    parent = None
-    # check current branch first
-    while temp != None:
-      if temp.taxon == d[spl[4]]:
-        parent = temp
-        break
-      temp = temp.parent
-    # if not found, check whole tree from root
-    if parent == None:
-      parent = checkTree(root, d[spl[4]])
+    parent = nodes.get(d[spl[4]])
     if parent == None:
       sys.stderr.write('Warning! Cannot find parent for ' \
         + 'taxon %s\n' % spl[4])
@@ -225,7 +246,7 @@ def loadScores(f, d):
       name = '<i>' + name + '</i>'  # italicize genus/species
     n = Node(parent, name, spl[4], spl[0], spl[1])
     parent.child.append(n)
-    temp = n
+    nodes[spl[4]] = n
 
     # save score
     score.append(int(spl[1]))
@@ -234,13 +255,15 @@ def loadScores(f, d):
 
 def findParent(d, taxon):
   '''
-  Find parent taxon (recursively).
+  Find parent taxon (walking up the tree iteratively).
   '''
-  if taxon not in d or d[taxon][0] not in d:
-    return None
-  if d[ d[taxon][0] ][1]:
-    return d[taxon][0]
-  return findParent(d, d[taxon][0])
+  for i in xrange(len(d)):
+    if taxon not in d or d[taxon][0] not in d:
+      return None
+    if d[ d[taxon][0] ][1]:
+      return d[taxon][0]
+    taxon = d[taxon][0]
+  return None  # cycle in tree
 
 def loadTax(f):
   '''
@@ -278,35 +301,309 @@ def loadTax(f):
 
   return d
 
-def main():
-  '''Main.'''
-  args = sys.argv[1:]
-  if len(args) < 3:
-    sys.stderr.write('Usage: python %s  ' % sys.argv[0] \
-      + '<kreport>  <taxTree>  <out> \ \n' \
-      + '    [<num>]  [<version>  <date>]\n' \
-      + '  <num>      Number of taxa to print (def. 20)\n' \
-      + '  <version>  Version of centrifuge\n' \
-      + '  <date>     Date of nt download\n')
-    sys.exit(-1)
+class TaxCache(object):
+  '''
+  TaxCache: canonical parent taxa, looked up (like the
+    dict from loadTax()) in a memory-mapped cache file
+    of parents indexed by taxon.
+  '''
+  __slots__ = ['mm', 'num']
+
+  def __init__(self, mm, num):
+    self.mm = mm
+    self.num = num
+
+  def get(self, taxon, default=None):
+    try:
+      t = int(taxon)
+    except ValueError:
+      return default
+    if t < 0 or t >= self.num:
+      return default
+    parent = ENTRY.unpack_from(self.mm, HEAD.size + ENTRY.size * t)[0]
+    return str(parent) if parent else default
+
+  def __contains__(self, taxon):
+    return self.get(taxon) != None
+
+  def __getitem__(self, taxon):
+    parent = self.get(taxon)
+    if parent == None:
+      raise KeyError(taxon)
+    return parent
 
-  # load tax tree
-  fTax = openRead(args[1])
+def checksum(filename):
+  '''
+  Calculate the CRC-32 of a file.
+  '''
+  crc = 0
+  f = open(filename, 'rb')
+  while True:
+    block = f.read(1048576)
+    if not block:
+      break
+    crc = zlib.crc32(block, crc)
+  f.close()
+  return crc & 0xffffffff
+
+def saveCache(d, filename):
+  '''
+  Write canonical parent taxa to the cache file, stamped
+    with the tree file's mtime, size, and checksum.
+    Return False if the taxa are not all numeric.
+  '''
+  try:
+    taxa = [(int(taxon), int(d[taxon])) for taxon in d]
+  except ValueError:
+    return False
+  num = max([t for t, parent in taxa] + [0]) + 1
+  arr = array.array('i', [0]) * num
+  for t, parent in taxa:
+    arr[t] = parent
+
+  st = os.stat(filename)
+  temp = filename + CACHE + '.tmp'
+  try:
+    f = open(temp, 'wb')
+    f.write(HEAD.pack(MAGIC, st.st_mtime, st.st_size, checksum(filename), \
+      num))
+    arr.tofile(f)
+    f.close()
+    os.rename(temp, filename + CACHE)
+  except (IOError, OSError):
+    sys.stderr.write('Warning! Cannot write taxonomy cache %s\n' \
+      % (filename + CACHE))
+  return True
+
+def loadCache(filename):
+  '''
+  Memory-map the cache file for a tree file. Return None
+    if it is missing or stale (tree file's size or checksum
+    changed; checksum verified only if mtime changed, after
+    which the header is restamped with the new mtime).
+  '''
+  try:
+    f = open(filename + CACHE, 'rb')
+    st = os.stat(filename)
+  except (IOError, OSError):
+    return None
+  head = f.read(HEAD.size)
+  if len(head) != HEAD.size:
+    f.close()
+    return None
+  magic, mtime, size, crc, num = HEAD.unpack(head)
+  if magic != MAGIC or size != st.st_size \
+      or os.path.getsize(filename + CACHE) != HEAD.size + ENTRY.size * num \
+      or (mtime != st.st_mtime and crc != checksum(filename)):
+    f.close()
+    return None
+  if mtime != st.st_mtime:
+    # checksum matches: restamp header with new mtime
+    try:
+      fHead = open(filename + CACHE, 'r+b')
+      fHead.write(HEAD.pack(MAGIC, st.st_mtime, size, crc, num))
+      fHead.close()
+    except IOError:
+      pass  # cache still valid (checksum verified each run)
+  mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  f.close()
+  return TaxCache(mm, num)
+
+def loadTree(filename):
+  '''
+  Load canonical parent taxa from the compiled cache of the
+    tree file, or parse the tree file (and compile the cache).
+  '''
+  if filename != '-':
+    d = loadCache(filename)
+    if d != None:
+      return d
+
+  fTax = openRead(filename)
   d = loadTax(fTax)
   if fTax != sys.stdin:
     fTax.close()
+    if not saveCache(d, filename):
+      sys.stderr.write('Warning! Cannot cache non-numeric taxa\n')
+  return d
 
+def makeReport(kreport, d, outFile, num, version, date):
+  '''
+  Produce the html summary of a Centrifuge report.
+    Return the unclassified score, tree, and cutoff.
+  '''
   # load scores and create taxonomic tree
-  fIn = openRead(args[0])
+  fIn = openRead(kreport)
   unclass, root, score = loadScores(fIn, d)
   if fIn != sys.stdin:
     fIn.close()
 
   # find cutoff score for top n taxa
+  cutoff = findCutoff(score, num)
+
+  # print output
+  fOut = openWrite(outFile)
+  printOutput(fOut, unclass, root, num, cutoff, version, date)
+  if fOut != sys.stdout:
+    fOut.close()
+  return unclass, root, cutoff
+
+def initWorker(d):
+  '''
+  Save the canonical parent taxa for a worker process.
+  '''
+  global tax
+  tax = d
+
+def runSample(kreport, outFile, num, version, date, matrix):
+  '''
+  Produce the html summary for one sample (in a worker
+    process). If matrix, return the unclassified score,
+    the taxa meeting the cutoff, and all taxa's names
+    and scores; else just the unclassified score.
+    Return None on error.
+  '''
+  try:
+    unclass, root, cutoff = makeReport(kreport, tax, outFile, num, \
+      version, date)
+  except SystemExit:
+    return None
+  if not matrix:
+    return unclass, None, None
+
+  top = []     # taxa meeting cutoff
+  taxa = {}    # taxon -> (name, score)
+  stack = list(reversed(root.child))
+  while stack:
+    n = stack.pop()
+    if n.count >= cutoff:
+      top.append(n.taxon)
+    taxa[n.taxon] = (n.name.replace('<i>', '').replace('</i>', ''), \
+      n.score)
+    stack.extend(reversed(n.child))
+  return unclass, top, taxa
+
+def listReports(path):
+  '''
+  List Centrifuge reports: files in a directory,
+    or those listed (one per line) in a file.
+  '''
+  if os.path.isdir(path):
+    return [os.path.join(path, x) for x in sorted(os.listdir(path)) \
+      if x[0] != '.' and os.path.isfile(os.path.join(path, x))]
+  f = openRead(path)
+  res = [line.strip() for line in f if line.strip()]
+  if f != sys.stdin:
+    f.close()
+  return res
+
+def sampleName(kreport):
+  '''
+  Name a sample by its report's filename (without extension).
+  '''
+  name = os.path.basename(kreport)
+  if name[-3:] == '.gz':
+    name = name[:-3]
+  if '.' in name:
+    name = name[:name.rfind('.')]
+  return name
+
+def printMatrix(f, samples, res):
+  '''
+  Print the scores of the samples' top taxa (union, in
+    order of first appearance), one column per sample.
+  '''
+  f.write('\t'.join(['taxon', 'name'] + samples) + '\n')
+  f.write('\t'.join(['0', 'unclassified'] \
+    + ['%.2f' % r[0] for r in res]) + '\n')
+  seen = set()
+  for r in res:
+    for taxon in r[1]:
+      if taxon in seen:
+        continue
+      seen.add(taxon)
+      name = [x[2][taxon][0] for x in res if taxon in x[2]][0]
+      f.write('\t'.join([taxon, name] + ['%.2f' % x[2][taxon][1] \
+        if taxon in x[2] else '0.00' for x in res]) + '\n')
+
+def runBatch(kreports, d, outDir, num, version, date, procs, matFile):
+  '''
+  Produce html summaries for multiple samples ('<outDir>/
+    <sample>.html') in a pool of worker processes, sharing
+    the loaded taxonomy. Optionally print a matrix of the
+    top taxa across samples.
+  '''
+  if not os.path.isdir(outDir):
+    try:
+      os.makedirs(outDir)
+    except OSError:
+      sys.stderr.write('Error! Cannot create directory %s\n' % outDir)
+      sys.exit(-1)
+  samples = [sampleName(x) for x in kreports]
+  if len(set(samples)) != len(samples):
+    sys.stderr.write('Error! Duplicate sample names\n')
+    sys.exit(-1)
+
+  pool = multiprocessing.Pool(procs, initWorker, (d,))
+  jobs = [pool.apply_async(runSample, (kreport, \
+    os.path.join(outDir, sample + '.html'), num, version, date, \
+    matFile != None)) for kreport, sample in zip(kreports, samples)]
+  res = [job.get() for job in jobs]
+  pool.close()
+  pool.join()
+  for kreport, r in zip(kreports, res):
+    if r == None:
+      sys.stderr.write('Error! Cannot process %s\n' % kreport)
+      sys.exit(-1)
+  sys.stderr.write('Samples processed: %d\n' % len(res))
+
+  if matFile != None:
+    fOut = openWrite(matFile)
+    printMatrix(fOut, samples, res)
+    if fOut != sys.stdout:
+      fOut.close()
+
+def main():
+  '''Main.'''
+  args = sys.argv[1:]
+  batch = False    # process multiple reports
+  procs = 1        # number of worker processes (batch mode)
+  matFile = None   # cross-sample matrix (batch mode)
+  while args and args[0] in ['-b', '-p', '-m']:
+    if args[0] == '-b':
+      batch = True
+      args = args[1:]
+    elif len(args) > 1:
+      if args[0] == '-p':
+        procs = int(args[1])
+      else:
+        matFile = args[1]
+      args = args[2:]
+    else:
+      args = []
+  if len(args) < 3:
+    sys.stderr.write('Usage: python %s  ' % sys.argv[0] \
+      + '<kreport>  <taxTree>  <out> \ \n' \
+      + '    [<num>]  [<version>  <date>]\n' \
+      + '   or: python %s  ' % sys.argv[0] \
+      + '-b [-p <int>] [-m <matrix>]  <kreports>  <taxTree>  <outDir> \ \n' \
+      + '    [<num>]  [<version>  <date>]\n' \
+      + '  <num>        Number of taxa to print (def. 20)\n' \
+      + '  <version>    Version of centrifuge\n' \
+      + '  <date>       Date of nt download\n' \
+      + '  -b           Batch mode: <kreports> is a directory of reports\n' \
+      + '               (or a file listing them); writes <outDir>/<sample>.html\n' \
+      + '  -p <int>     Number of worker processes (def. 1)\n' \
+      + '  -m <matrix>  Write a matrix of top taxa across samples\n')
+    sys.exit(-1)
+
+  # load tax tree (compiled cache, if available)
+  d = loadTree(args[1])
+
+  # find number of taxa to print
   num = 20
   if len(args) > 3:
     num = int(args[3])
-  cutoff = findCutoff(score, num)
 
   # load centrifuge version, date of nt download
   version = date = ''
@@ -315,10 +612,11 @@ def main():
     date = args[5]
 
   # print output
-  fOut = openWrite(args[2])
-  printOutput(fOut, unclass, root, num, cutoff, version, date)
-  if fOut != sys.stdout:
-    fOut.close()
+  if batch:
+    runBatch(listReports(args[0]), d, args[2], num, version, date, \
+      procs, matFile)
+  else:
+    makeReport(args[0], d, args[2], num, version, date)
 
 if __name__ == '__main__':
   main()
@@ -6,7 +6,25 @@
 #   checking for mismatches.
 
 import sys
+import string
+import os
 import gzip
+import zlib
+import struct
+import heapq
+import tempfile
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# complements of DNA (IUPAC) codes, for revComp()
+DNA = 'ACGTRYKMSWBDHVNacgtrykmswbdhvn'
+COMP = string.maketrans(DNA, 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn')
+NONDNA = ''.join([chr(i) for i in xrange(256) if chr(i) not in DNA])
+
+BATCH = 10000    # reads per batch of diff comparisons
+CHUNK = 1000000  # lines (stitch diffs, index entries) sorted in memory at once
 
 def openRead(filename):
   '''
@@ -44,19 +62,13 @@ def openWrite(filename):
 
 def revComp(dna):
   '''
-  Reverse-complements the given DNA sequence.
+  Reverse-complement the given DNA sequence
+    (IUPAC codes, upper or lower case).
   '''
-  rc = ''
-  for nuc in dna[::-1]:
-    comp = ''
-    if nuc == 'A': comp = 'T'
-    elif nuc == 'C': comp = 'G'
-    elif nuc == 'G': comp = 'C'
-    elif nuc == 'T': comp = 'A'
-    elif nuc == 'N': comp = 'N'
-    else:
+  rc = dna[::-1].translate(COMP, NONDNA)
+  if len(rc) != len(dna):
+    for nuc in dna.translate(None, DNA):
       print 'Error! Unknown nucleotide: %s' % nuc
-    rc += comp
   return rc
 
 def loadFastq(f1):
@@ -144,16 +156,270 @@ def retrieveReads(r1, r2, d):
       count -= 1
     line1 = r1.readline().split(' ')[0]
     line2 = r2.readline().split(' ')[0]
+  return raw
+
+def isBgzf(filename):
+  '''
+  Determine if a file is BGZF-compressed (gzip with a 'BC'
+    extra subfield in its first block header).
+  '''
+  f = open(filename, 'rb')
+  header = f.read(18)
+  f.close()
+  return len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04' \
+    and header[12:14] == 'BC'
+
+def readBlock(f):
+  '''
+  Read and decompress one BGZF block. Return None at EOF.
+  '''
+  header = f.read(12)
+  if len(header) < 12:
+    return None
+  xlen = struct.unpack('<H', header[10:12])[0]
+  extra = f.read(xlen)
+  bsize = -1
+  i = 0
+  while i + 4 <= xlen:
+    slen = struct.unpack('<H', extra[i+2:i+4])[0]
+    if extra[i:i+2] == 'BC':
+      bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+    i += 4 + slen
+  if bsize == -1:
+    sys.stderr.write('Error! Not BGZF format\n')
+    sys.exit(-1)
+  cdata = f.read(bsize - xlen - 19)
+  f.read(8)  # CRC32 and ISIZE
+  return zlib.decompress(cdata, -15)
+
+def bgzfLines(f):
+  '''
+  Generate (virtual offset, line) for each line of a BGZF file.
+  '''
+  part = ''     # partial line carried over from previous block
+  start = None  # virtual offset of partial line
+  while True:
+    coffset = f.tell()
+    data = readBlock(f)
+    if data == None:
+      break
+    pos = 0
+    while pos < len(data):
+      if start == None:
+        start = coffset << 16 | pos
+      end = data.find('\n', pos)
+      if end == -1:
+        part += data[pos:]
+        break
+      yield start, part + data[pos:end+1]
+      part = ''
+      start = None
+      pos = end + 1
+  if part:
+    yield start, part
+
+def plainLines(f):
+  '''
+  Generate (byte offset, line) for each line of an uncompressed file.
+  '''
+  offset = f.tell()
+  line = f.readline()
+  while line:
+    yield offset, line
+    offset = f.tell()
+    line = f.readline()
+
+def canIndex(filename):
+  '''
+  Determine if a fastq file can be accessed via an offset
+    index (uncompressed or BGZF, not stdin).
+  '''
+  if filename == '-' or not os.path.isfile(filename):
+    return False
+  return filename[-3:] != '.gz' or isBgzf(filename)
+
+def buildIndex(filename, idxFile):
+  '''
+  Write an index of read name -> file offset (virtual
+    offset for BGZF), sorted by read name. Entries are
+    sorted in chunks that are spilled to temp files and
+    merged (as in sortLines()). Return False if the index
+    cannot be written.
+  '''
+  try:
+    fOut = open(idxFile + '.tmp', 'w')
+  except IOError:
+    return False
+  f = open(filename, 'rb')
+  if isBgzf(filename):
+    lines = bgzfLines(f)
+  else:
+    lines = plainLines(f)
+  temps = []
+  chunk = []  # (read, index, index line)
+  i = count = 0
+  for offset, line in lines:
+    if i % 4 == 0:
+      if line[0] != '@':
+        sys.stderr.write('Error! Not FASTQ format\n')
+        sys.exit(-1)
+      head = line.split(' ')[0][1:].rstrip()
+      chunk.append((head, count, '%s\t%d\n' % (head, offset)))
+      count += 1
+      if len(chunk) == CHUNK:
+        temps.append((spillChunk(chunk), count - CHUNK))
+        chunk = []
+    i += 1
+  f.close()
+  chunk.sort()
+  recs = heapq.merge(iter(chunk), \
+    *[readChunk(temp, j) for temp, j in temps])
 
+  try:
+    for rec in recs:
+      fOut.write(rec[2])
+    fOut.close()
+    os.rename(idxFile + '.tmp', idxFile)
+  except (IOError, OSError):
+    return False
+  sys.stderr.write('Reads indexed in %s: %d\n' % (filename, count))
+  return True
+
+def loadIndex(filename):
+  '''
+  Open the offset index of a fastq file ('<fastq>.fqi'),
+    building it first if it is missing or out of date.
+    Return None if it cannot be built (e.g. read-only dir).
+  '''
+  idxFile = filename + '.fqi'
+  if not os.path.isfile(idxFile) \
+      or os.path.getmtime(idxFile) < os.path.getmtime(filename):
+    if not buildIndex(filename, idxFile):
+      sys.stderr.write('Warning! Cannot write index %s\n' % idxFile)
+      return None
+  return open(idxFile, 'rb'), os.path.getsize(idxFile)
+
+def searchIndex(f, size, head):
+  '''
+  Binary search a sorted index file for a read name.
+    Return its offset, or None if not found.
+  '''
+  lo = 0
+  hi = size
+  while lo < hi:
+    mid = (lo + hi) // 2
+    f.seek(mid)
+    if mid:
+      f.readline()  # skip to start of next line
+    line = f.readline()
+    if not line or line.split('\t')[0] >= head:
+      hi = mid
+    else:
+      lo = mid + 1
+  f.seek(lo)
+  if lo:
+    f.readline()
+  spl = f.readline().rstrip().split('\t')
+  if spl[0] == head and len(spl) > 1:
+    return int(spl[1])
+  return None
+
+def readRecord(f, offset, bgzf):
+  '''
+  Read a 4-line fastq record starting at given offset.
+  '''
+  if not bgzf:
+    f.seek(offset)
+    return [f.readline() for i in xrange(4)]
+  f.seek(offset >> 16)
+  data = readBlock(f)[offset & 0xFFFF:]
+  while data.count('\n') < 4:
+    block = readBlock(f)
+    if not block:
+      break
+    data += block
+  return data.split('\n')[:4]
+
+def retrieveIndexed(file1, file2, d):
+  '''
+  Retrieve reads from r1/r2 based on headers in d,
+    seeking to each via offset indexes. Return None
+    if the indexes are not available.
+  '''
+  res1 = loadIndex(file1)
+  res2 = loadIndex(file2)
+  if res1 == None or res2 == None:
+    for res in [res1, res2]:
+      if res != None:
+        res[0].close()
+    return None
+  idx1, size1 = res1
+  idx2, size2 = res2
+  raw = dict()
+  bgzf1 = isBgzf(file1)
+  bgzf2 = isBgzf(file2)
+  r1 = open(file1, 'rb')
+  r2 = open(file2, 'rb')
+  for head in d:
+    read = head[1:].rstrip()
+    off1 = searchIndex(idx1, size1, read)
+    off2 = searchIndex(idx2, size2, read)
+    if off1 == None or off2 == None:
+      continue
+    rec1 = readRecord(r1, off1, bgzf1)
+    rec2 = readRecord(r2, off2, bgzf2)
+    if rec1[0].split(' ')[0].rstrip() != rec2[0].split(' ')[0].rstrip():
+      sys.stderr.write('Error! R1/R2 files do not match:\n' \
+        + rec1[0] + rec2[0])
+      sys.exit(-1)
+    raw[head] = [rec1[1].rstrip(), rec1[3].rstrip(), \
+      revComp(rec2[1].rstrip()), rec2[3].rstrip()[::-1]]
+  r1.close()
+  r2.close()
+  idx1.close()
+  idx2.close()
   return raw
 
+def diffPositions(seqs1, seqs2):
+  '''
+  Find positions of sequence diffs and Ns for a batch of
+    aligned read pairs. Return a list of positions per pair.
+    Uses numpy byte-array comparisons when available.
+  '''
+  lens = [min(len(s1), len(s2)) for s1, s2 in zip(seqs1, seqs2)]
+  pos = [[] for n in lens]
+  if numpy == None:
+    for j in xrange(len(lens)):
+      s1 = seqs1[j]
+      s2 = seqs2[j]
+      for i in xrange(lens[j]):
+        if (s1[i] != s2[i] and s2[i] != ' ') \
+            or s1[i] == 'N' or s2[i] == 'N':
+          pos[j].append(i)
+    return pos
+  if not sum(lens):
+    return pos
+
+  # concatenate reads, compare all positions at once
+  a = numpy.frombuffer(''.join([s[:n] for s, n in zip(seqs1, lens)]),
+    dtype=numpy.uint8)
+  b = numpy.frombuffer(''.join([s[:n] for s, n in zip(seqs2, lens)]),
+    dtype=numpy.uint8)
+  mask = ((a != b) & (b != ord(' '))) | (a == ord('N')) | (b == ord('N'))
+  hits = numpy.flatnonzero(mask)
+
+  # map hits back to reads
+  starts = numpy.cumsum([0] + lens[:-1])
+  idx = numpy.searchsorted(starts, hits, side='right') - 1
+  for j, i in zip(idx.tolist(), (hits - starts[idx]).tolist()):
+    pos[j].append(i)
+  return pos
+
 def findDiffs(d2, raw):
   '''Return dict of alignment diffs and Ns.'''
   d = dict()
-  for head in raw:
-    read = head[1:].rstrip()
-    d[read] = list()
-
+  heads = list(raw)
+  for head in heads:
     # position alignment according to length in d2 dict
     offset = len(d2[head][0]) - len(raw[head][2])
     if offset < 0:
@@ -163,24 +429,74 @@ def findDiffs(d2, raw):
       raw[head][2] = ' ' * (offset) + raw[head][2]
       raw[head][3] = ' ' * (offset) + raw[head][3]
 
-    # check for sequence diffs, Ns
-    for i in range(min(len(raw[head][0]), len(raw[head][2]))):
-      if (raw[head][0][i] != raw[head][2][i] and raw[head][2][i] != ' ') \
-          or raw[head][0][i] == 'N' or raw[head][2][i] == 'N':
-        d[read].append('\t'.join([str(i), raw[head][0][i], raw[head][1][i], \
-          raw[head][2][i], raw[head][3][i]]))
+  # check for sequence diffs, Ns (in batches)
+  for j in xrange(0, len(heads), BATCH):
+    batch = heads[j:j+BATCH]
+    pos = diffPositions([raw[head][0] for head in batch], \
+      [raw[head][2] for head in batch])
+    for head, p in zip(batch, pos):
+      r = raw[head]
+      d[head[1:].rstrip()] = ['\t'.join([str(i), r[0][i], r[1][i], \
+        r[2][i], r[3][i]]) for i in p]
   return d
 
-def printOutput(f, fOut, d):
-  '''Produce output. Copy stitch diffs from f, except
-     for reads in d. Append diffs from d.'''
+def spillChunk(chunk):
+  '''
+  Write a sorted chunk of (read, index, line) to a temp file.
+  '''
+  chunk.sort()
+  temp = tempfile.TemporaryFile()
+  for rec in chunk:
+    temp.write(rec[2])
+  temp.seek(0)
+  return temp
+
+def readChunk(temp, idx):
+  '''
+  Generate (read, index, line) from a sorted temp file.
+  '''
+  for line in temp:
+    yield line.split('\t')[0], idx, line
+    idx += 1
+  temp.close()
+
+def sortLines(f):
+  '''
+  Generate (read, index, line) of stitch diffs in f, sorted
+    by read name (stable). Lines are sorted in chunks that
+    are spilled to temp files and merged if f is large.
+  '''
+  temps = []
+  chunk = []
+  idx = 0
   for line in f:
-    spl = line.split('\t')
-    if spl[0] not in d:
-      fOut.write(line)
-  for r in d:
-    for i in range(len(d[r])):
-      fOut.write(r + '\t' + d[r][i] + '\n')
+    chunk.append((line.split('\t')[0], idx, line))
+    idx += 1
+    if len(chunk) == CHUNK:
+      temps.append((spillChunk(chunk), idx - CHUNK))
+      chunk = []
+  if not temps:
+    chunk.sort()
+    return iter(chunk)
+  if chunk:
+    temps.append((spillChunk(chunk), idx - len(chunk)))
+  return heapq.merge(*[readChunk(temp, i) for temp, i in temps])
+
+def printOutput(f, fOut, d):
+  '''Produce output, sorted by read name. Copy stitch
+     diffs from f, except for reads in d, whose diffs
+     are merged in at their sorted positions.'''
+  reads = sorted(d)
+  j = 0
+  for rec in sortLines(f):
+    while j < len(reads) and reads[j] <= rec[0]:
+      fOut.write(''.join([reads[j] + '\t' + diff + '\n' \
+        for diff in d[reads[j]]]))
+      j += 1
+    if rec[0] not in d:
+      fOut.write(rec[2])
+  for r in reads[j:]:
+    fOut.write(''.join([r + '\t' + diff + '\n' for diff in d[r]]))
   f.close()
 
 def main():
@@ -202,10 +518,14 @@ def main():
   sys.stderr.write('  Missing  : %d\n' % (miss))
   sys.stderr.write('  DiffLen  : %d\n' % (diff))
 
-  # retrieve original reads
-  r1 = openRead(args[2])
-  r2 = openRead(args[3])
-  raw = retrieveReads(r1, r2, d2)
+  # retrieve original reads (via offset indexes if possible)
+  raw = None
+  if canIndex(args[2]) and canIndex(args[3]):
+    raw = retrieveIndexed(args[2], args[3], d2)
+  if raw == None:
+    r1 = openRead(args[2])
+    r2 = openRead(args[3])
+    raw = retrieveReads(r1, r2, d2)
   sys.stderr.write('Reads retrieved: %d\n' % (len(raw)))
 
   # determine differences
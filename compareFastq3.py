@@ -5,7 +5,19 @@
 # Reconstructing mismatches of merged PE reads.
 
 import sys
+import string
 import gzip
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# complements of DNA (IUPAC) codes, for revComp()
+DNA = 'ACGTRYKMSWBDHVNacgtrykmswbdhvn'
+COMP = string.maketrans(DNA, 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn')
+NONDNA = ''.join([chr(i) for i in xrange(256) if chr(i) not in DNA])
+
+BATCH = 10000  # reads per batch of diff comparisons
 
 def openRead(filename):
   '''
@@ -43,19 +55,13 @@ def openWrite(filename):
 
 def revComp(dna):
   '''
-  Reverse-complements the given DNA sequence.
+  Reverse-complement the given DNA sequence
+    (IUPAC codes, upper or lower case).
   '''
-  rc = ''
-  for nuc in dna[::-1]:
-    comp = ''
-    if nuc == 'A': comp = 'T'
-    elif nuc == 'C': comp = 'G'
-    elif nuc == 'G': comp = 'C'
-    elif nuc == 'T': comp = 'A'
-    elif nuc == 'N': comp = 'N'
-    else:
+  rc = dna[::-1].translate(COMP, NONDNA)
+  if len(rc) != len(dna):
+    for nuc in dna.translate(None, DNA):
       print 'Error! Unknown nucleotide: %s' % nuc
-    rc += comp
   return rc
 
 def loadFastq(f):
@@ -126,11 +132,50 @@ def retrieveReads(r1, r2, d):
     r2.close()
   return raw
 
+def diffPositions(seqs1, seqs2):
+  '''
+  Find positions of sequence diffs and Ns for a batch of
+    aligned read pairs. Return a list of positions per pair.
+    Uses numpy byte-array comparisons when available.
+  '''
+  lens = [min(len(s1), len(s2)) for s1, s2 in zip(seqs1, seqs2)]
+  pos = [[] for n in lens]
+  if numpy == None:
+    for j in xrange(len(lens)):
+      s1 = seqs1[j]
+      s2 = seqs2[j]
+      for i in xrange(lens[j]):
+        if (s1[i] != s2[i] and s2[i] != ' ') \
+            or (s1[i] == 'N' and s2[i] != ' ') \
+            or (s2[i] == 'N' and s1[i] != ' '):
+          pos[j].append(i)
+    return pos
+  if not sum(lens):
+    return pos
+
+  # concatenate reads, compare all positions at once
+  a = numpy.frombuffer(''.join([s[:n] for s, n in zip(seqs1, lens)]),
+    dtype=numpy.uint8)
+  b = numpy.frombuffer(''.join([s[:n] for s, n in zip(seqs2, lens)]),
+    dtype=numpy.uint8)
+  gap1 = a == ord(' ')
+  gap2 = b == ord(' ')
+  mask = ((a != b) & ~gap2) | ((a == ord('N')) & ~gap2) \
+    | ((b == ord('N')) & ~gap1)
+  hits = numpy.flatnonzero(mask)
+
+  # map hits back to reads
+  starts = numpy.cumsum([0] + lens[:-1])
+  idx = numpy.searchsorted(starts, hits, side='right') - 1
+  for j, i in zip(idx.tolist(), (hits - starts[idx]).tolist()):
+    pos[j].append(i)
+  return pos
+
 def printDiffs(fOut, d, raw):
   '''Print alignment diffs and Ns.'''
   count = 0
-  for head in raw:
-
+  heads = list(raw)
+  for head in heads:
     # position alignment according to length in d dict
     offset = d[head] - len(raw[head][2])
     if offset < 0:
@@ -140,15 +185,19 @@ def printDiffs(fOut, d, raw):
       raw[head][2] = ' ' * (offset) + raw[head][2]
       raw[head][3] = ' ' * (offset) + raw[head][3]
 
-    # find and print diffs, Ns
-    for i in range(min(len(raw[head][0]), len(raw[head][2]))):
-      if (raw[head][0][i] != raw[head][2][i] and raw[head][2][i] != ' ') \
-          or (raw[head][0][i] == 'N' and raw[head][2][i] != ' ') \
-          or (raw[head][2][i] == 'N' and raw[head][0][i] != ' '):
-        fOut.write('\t'.join([head[1:], str(i), \
-          raw[head][0][i], raw[head][1][i], \
-          raw[head][2][i], raw[head][3][i]]) + '\n')
-        count += 1
+  # find and print diffs, Ns (in batches)
+  for j in xrange(0, len(heads), BATCH):
+    batch = heads[j:j+BATCH]
+    pos = diffPositions([raw[head][0] for head in batch], \
+      [raw[head][2] for head in batch])
+    res = []
+    for head, p in zip(batch, pos):
+      r = raw[head]
+      for i in p:
+        res.append('\t'.join([head[1:], str(i), r[0][i], r[1][i], \
+          r[2][i], r[3][i]]) + '\n')
+    fOut.write(''.join(res))
+    count += len(res)
 
   return count
 
@@ -10,9 +10,15 @@
 # Version 8: counting matches based on qual scores too
 
 import sys
+import string
 import gzip
 import re
 
+# complements of DNA (IUPAC) codes, for revComp()
+DNA = 'ACGTRYKMSWBDHVNacgtrykmswbdhvn'
+COMP = string.maketrans(DNA, 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn')
+NONDNA = ''.join([chr(i) for i in xrange(256) if chr(i) not in DNA])
+
 def openRead(filename):
   '''
   Open filename for reading. '-' indicates stdin.
@@ -258,19 +264,13 @@ def processSAM(fIn, fOut, raw, maxQual):
 
 def revComp(dna):
   '''
-  Reverse-complements the given DNA sequence.
+  Reverse-complement the given DNA sequence
+    (IUPAC codes, upper or lower case).
   '''
-  rc = ''
-  for nuc in dna[::-1]:
-    comp = ''
-    if nuc == 'A': comp = 'T'
-    elif nuc == 'C': comp = 'G'
-    elif nuc == 'G': comp = 'C'
-    elif nuc == 'T': comp = 'A'
-    elif nuc == 'N': comp = 'N'
-    else:
+  rc = dna[::-1].translate(COMP, NONDNA)
+  if len(rc) != len(dna):
+    for nuc in dna.translate(None, DNA):
       print 'Error! Unknown nucleotide: %s' % nuc
-    rc += comp
   return rc
 
 def loadReads(r1, r2):
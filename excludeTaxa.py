@@ -6,85 +6,125 @@
 #   assigned to a given taxon's subtree.
 
 import sys
-import gzip
+import multiprocessing
+import struct
+import array
+import mmap
+import bisect
+import heapq
+import tempfile
+import collections
+import itertools
+from gzipIO import openRead, openWrite
 
-def openRead(filename):
+CHUNK = 5000000   # accessions sorted in memory at once (index build)
+STEP = 1024       # index records per in-memory search key
+BLOCK = 16 * 1024 * 1024  # bytes of fasta filtered at once
+MAGIC = 'EXACC01\n'
+HEAD = struct.Struct('<8siq')  # magic, key length, records
+TAXID = struct.Struct('<i')    # taxID following each (padded) accession
+
+def readBlocks(fIn, size=BLOCK):
   '''
-  Open filename for reading. '-' indicates stdin.
-    '.gz' suffix indicates gzip compression.
+  Generate blocks of a fasta file (of about size bytes),
+    each ending at a record boundary.
   '''
-  if filename == '-':
-    return sys.stdin
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'rb')
-    else:
-      f = open(filename, 'rU')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for reading\n' % filename)
-    sys.exit(-1)
-  return f
+  rest = ''  # partial record from end of previous block
+  while True:
+    block = fIn.read(size)
+    if not block:
+      break
+    block = rest + block
+    i = block.rfind('\n>')
+    if i == -1:
+      rest = block
+      continue
+    yield block[:i+1]
+    rest = block[i+1:]
+  if rest:
+    yield rest
 
-def openWrite(filename):
+def initFilter(taxa, acc2tax):
   '''
-  Open filename for writing. '-' indicates stdout.
-    '.gz' suffix indicates gzip compression.
+  Save lookup tables for filterBlock() (in each process).
   '''
-  if filename == '-':
-    return sys.stdout
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'wb')
-    else:
-      f = open(filename, 'w')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for writing\n' % filename)
-    sys.exit(-1)
-  return f
+  global filterArgs
+  filterArgs = (taxa, acc2tax)
 
-def parseFasta(fIn, fOut, taxa, acc2tax):
+def filterBlock(block):
   '''
-  Parse fasta file, write output on the fly.
+  Filter the fasta records in a block. Records to keep are
+    copied as slices of the block (consecutive ones as one
+    slice). Return output and counts.
   '''
+  taxa, acc2tax = filterArgs
   count = short = xReads = total = 0
-  head = ''    # header (1st space-delim token)
-  read = ''    # full read (header + sequence)
-
-  # analyze fasta reads
-  for line in fIn:
-    if line[0] == '>':
-
-      # process previous read
-      if read:
-        count += 1
-        if head in acc2tax and acc2tax[head] in taxa:
-          xReads += 1
-        else:
-          fOut.write(read)
-          total += 1
-        if head not in acc2tax:
-          short += 1
-
-      # start new read
-      read = line
-      head = line.rstrip().split(' ')[0][1:]
+  out = []
+  keep = 0   # start of records kept (not yet saved)
+  start = 0  # start of record
+  while start < len(block):
+    end = block.find('\n>', start) + 1
+    if end == 0:
+      end = len(block)
 
-    else:
-      # save sequence
-      read += line
+    # find header (1st space-delim token)
+    head = ''
+    if block[start] == '>':
+      eol = block.find('\n', start, end)
+      if eol == -1:
+        eol = end
+      head = block[start+1:eol].rstrip().split(' ')[0]
 
-  # process last read
-  if read:
     count += 1
-    if head in acc2tax and acc2tax[head] in taxa:
+    tax = acc2tax.get(head)
+    if tax != None and tax in taxa:
       xReads += 1
+      out.append(block[keep:start])
+      keep = end
     else:
-      fOut.write(read)
       total += 1
-    if head not in acc2tax:
+    if tax == None:
       short += 1
+    start = end
 
-  return count, short, xReads, total
+  out.append(block[keep:])
+  return ''.join(out), (count, short, xReads, total)
+
+def poolBlocks(pool, procs, blocks):
+  '''
+  Generate results of blocks filtered by the pool,
+    in input order, with at most 2*procs pending.
+  '''
+  pending = collections.deque()
+  for block in blocks:
+    pending.append(pool.apply_async(filterBlock, (block,)))
+    if len(pending) > 2 * procs:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def parseFasta(fIn, fOut, taxa, acc2tax, procs=1):
+  '''
+  Parse fasta file in blocks, write output on the fly.
+    Blocks are filtered by a pool of worker processes
+    if procs > 1, with output written in input order.
+  '''
+  stats = [0, 0, 0, 0]  # count, short, xReads, total
+  initFilter(taxa, acc2tax)
+  if procs < 2:
+    results = (filterBlock(block) for block in readBlocks(fIn))
+  else:
+    pool = multiprocessing.Pool(procs, initFilter, (taxa, acc2tax))
+    results = poolBlocks(pool, procs, readBlocks(fIn))
+  for out, counts in results:
+    fOut.write(out)
+    for i in xrange(len(stats)):
+      stats[i] += counts[i]
+  if procs >= 2:
+    pool.close()
+    pool.join()
+
+  return tuple(stats)
 
 def loadAcc(f):
   '''
@@ -101,11 +141,141 @@ def loadAcc(f):
     #d[spl[0]] = spl[1]  # for filtered/updated acc2taxid file
   return d
 
-def findTaxa(f, taxon):
+def spillChunk(chunk):
+  '''
+  Write a sorted chunk of (accession, line number, taxID)
+    to a temp file.
+  '''
+  chunk.sort()
+  temp = tempfile.TemporaryFile()
+  for acc, num, tax in chunk:
+    temp.write('%s\t%d\t%s\n' % (acc, num, tax))
+  temp.seek(0)
+  return temp
+
+def readChunk(temp):
+  '''
+  Generate (accession, line number, taxID) from a sorted
+    temp file.
+  '''
+  for line in temp:
+    spl = line.rstrip('\n').split('\t')
+    yield spl[0], int(spl[1]), spl[2]
+  temp.close()
+
+def buildIndex(f, idxFile):
   '''
-  Load all taxa in given taxon's subtree.
+  Convert accession -> taxID info to a sorted index file
+    of fixed-width records: accession ('\\0'-padded to the
+    longest) and taxID (int32). Accessions are sorted in
+    chunks that are spilled to temp files and merged.
+    Lines with non-numeric taxIDs (header) are skipped.
+    For duplicate accessions, the last in the input is
+    kept (as in loadAcc()).
+  '''
+  temps = []
+  chunk = []
+  keyLen = 0
+  for i, line in enumerate(f):
+    spl = line.rstrip().split('\t')
+    if len(spl) < 4:    # for raw accession2taxid.gz file
+    #if len(spl) < 2:    # for filtered/updated acc2taxid file
+      sys.stderr.write('Error! Improperly formatted acc2taxid file\n')
+      sys.exit(-1)
+    acc, tax = spl[1], spl[2]  # for raw accession2taxid.gz file
+    #acc, tax = spl[0], spl[1]  # for filtered/updated acc2taxid file
+    if not tax.isdigit():
+      continue  # header
+    chunk.append((acc, i, tax))
+    keyLen = max(keyLen, len(acc))
+    if len(chunk) == CHUNK:
+      temps.append(spillChunk(chunk))
+      chunk = []
+  chunk.sort()
+  recs = heapq.merge(iter(chunk), *[readChunk(temp) for temp in temps])
+
+  # write records (last in input of any duplicate accessions)
+  fOut = open(idxFile, 'wb')
+  fOut.write(HEAD.pack(MAGIC, keyLen, 0))
+  num = 0
+  prev = None  # (accession, taxID) awaiting write
+  for acc, i, tax in itertools.chain(recs, [(None, 0, None)]):
+    if prev != None and acc != prev[0]:
+      try:
+        fOut.write(prev[0].ljust(keyLen, '\0') + TAXID.pack(int(prev[1])))
+      except struct.error:
+        sys.stderr.write('Error! Invalid taxID for %s: %s\n' % prev)
+        sys.exit(-1)
+      num += 1
+    prev = (acc, tax)
+  fOut.seek(0)
+  fOut.write(HEAD.pack(MAGIC, keyLen, num))
+  fOut.close()
+  return num
+
+def isIndex(filename):
+  '''
+  Determine if a file is an accession index (from buildIndex()).
+  '''
+  if filename == '-' or filename[-3:] == '.gz':
+    return False
+  try:
+    f = open(filename, 'rb')
+  except IOError:
+    return False
+  magic = f.read(len(MAGIC))
+  f.close()
+  return magic == MAGIC
+
+class AccIndex(object):
+  '''
+  AccIndex: accession -> taxID lookup (like the dict
+    from loadAcc()) by binary search of a memory-mapped
+    index file. Every STEP-th accession is kept in memory
+    to narrow each search.
+  '''
+  def __init__(self, filename):
+    f = open(filename, 'rb')
+    magic, self.keyLen, self.num = HEAD.unpack(f.read(HEAD.size))
+    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    self.size = self.keyLen + TAXID.size
+    self.top = [self.key(i) for i in xrange(0, self.num, STEP)]
+
+  def key(self, i):
+    off = HEAD.size + i * self.size
+    return self.mm[off : off + self.keyLen]
+
+  def get(self, acc, default=None):
+    if len(acc) > self.keyLen:
+      return default
+    key = acc.ljust(self.keyLen, '\0')
+    j = bisect.bisect_right(self.top, key) - 1
+    if j < 0:
+      return default
+    lo = j * STEP
+    hi = min(lo + STEP, self.num)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.key(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo == self.num or self.key(lo) != key:
+      return default
+    return str(TAXID.unpack_from(self.mm, \
+      HEAD.size + lo * self.size + self.keyLen)[0])
+
+  def __len__(self):
+    return self.num
+
+  def close(self):
+    self.mm.close()
+
+def loadTree(f):
+  '''
+  Load immediate parent of each taxon.
   '''
-  # load immediate parent taxa and counts to dict
   temp = {}
   for line in f:
     spl = line.split('|')
@@ -113,46 +283,132 @@ def findTaxa(f, taxon):
       sys.stderr.write('Error! Improperly formatted tree file\n')
       sys.exit(-1)
     temp[spl[0].strip()] = spl[1].strip()
+  return temp
 
-  # save taxa from subtree
-  d = {}
-  d[taxon] = 1
-  for tax in temp:
-    parent = temp[tax]
-    while parent != 'None':
-      if parent in d:
-        d[tax] = 1
-        break
-      parent = temp[parent]
+def eulerTour(parents):
+  '''
+  Number the taxa in preorder (iteratively, from each
+    root). Return taxon -> number, and the number of the
+    last taxon in each taxon's subtree (indexed by number).
+  '''
+  child = {}
+  roots = []
+  for tax in parents:
+    parent = parents[tax]
+    if parent == tax or parent not in parents:
+      roots.append(tax)  # e.g. parent 'None'
+    else:
+      if parent not in child:
+        child[parent] = []
+      child[parent].append(tax)
 
-  return d
+  num = {}                 # taxon -> preorder number
+  last = array.array('l')  # number -> last number in subtree
+  stack = [(tax, False) for tax in sorted(roots, reverse=True)]
+  while stack:
+    tax, done = stack.pop()
+    if done:
+      last[num[tax]] = len(num) - 1
+      continue
+    num[tax] = len(num)
+    last.append(len(num) - 1)
+    stack.append((tax, True))
+    stack.extend([(c, False) for c in child.get(tax, [])])
+  return num, last
+
+class Subtrees(object):
+  '''
+  Subtrees: membership of taxa in the subtrees of given
+    taxa. Each subtree is an interval of preorder numbers
+    (see eulerTour()), so a lookup is a bisect over the
+    (merged) intervals.
+  '''
+  def __init__(self, num, last, taxa):
+    self.num = num
+    self.extra = set()  # given taxa not in tree
+    ivals = []
+    for tax in taxa:
+      if tax in num:
+        ivals.append((num[tax], last[num[tax]]))
+      else:
+        self.extra.add(tax)
+    self.start = []
+    self.end = []
+    for s, e in sorted(ivals):
+      if self.end and s <= self.end[-1]:
+        self.end[-1] = max(self.end[-1], e)  # nested subtree
+      else:
+        self.start.append(s)
+        self.end.append(e)
+
+  def __contains__(self, tax):
+    if tax in self.extra:
+      return True
+    pos = self.num.get(tax)
+    if pos == None:
+      return False
+    i = bisect.bisect_right(self.start, pos) - 1
+    return i >= 0 and pos <= self.end[i]
+
+  def __len__(self):
+    return sum([e - s + 1 for s, e in zip(self.start, self.end)]) \
+      + len(self.extra)
+
+def findTaxa(f, taxa):
+  '''
+  Find all taxa in given taxa's subtrees.
+  '''
+  num, last = eulerTour(loadTree(f))
+  return Subtrees(num, last, taxa)
 
 def main():
   '''Main.'''
   args = sys.argv[1:]
-  if len(args) < 3:
+  procs = 1  # number of worker processes
+  if len(args) > 1 and args[0] == '-p':
+    procs = int(args[1])
+    args = args[2:]
+  if len(args) == 3 and args[0] == '-i':
+    # build accession index
+    fAcc = openRead(args[1])
+    num = buildIndex(fAcc, args[2])
+    if fAcc != sys.stdin:
+      fAcc.close()
+    sys.stderr.write('Accessions indexed: %d\n' % num)
+    return
+  if len(args) < 5:
     sys.stderr.write('Usage: python %s  ' % sys.argv[0] \
-      + '<taxon>  <taxTree>  <acc2taxid>  <in>  <out>\n')
+      + '[-p <int>]  <taxon>  <taxTree>  <acc2taxid>  <in>  <out>\n' \
+      + '   or: python %s  -i  <acc2taxid>  <index>\n' % sys.argv[0] \
+      + '  <taxon>   Taxon whose subtree is excluded (or a\n' \
+      + '              comma-separated list of taxa)\n' \
+      + '  -p <int>  Number of worker processes (def. 1)\n' \
+      + '  -i        Build an index of <acc2taxid> (sorted, on disk),\n' \
+      + '              to be given as <acc2taxid> in later runs\n')
     sys.exit(-1)
 
-  # find all taxa in given taxon's subtree
+  # find all taxa in given taxa's subtrees
   taxon = args[0]
   fTax = openRead(args[1])
-  taxa = findTaxa(fTax, taxon)
+  taxa = findTaxa(fTax, taxon.split(','))
   if fTax != sys.stdin:
     fTax.close()
   sys.stderr.write('Taxa in subtree of %s: %d\n' % (taxon, len(taxa)))
 
-  # load accession -> taxID info
-  fAcc = openRead(args[2])
-  acc2tax = loadAcc(fAcc)
-  if fAcc != sys.stdin:
-    fAcc.close()
+  # load accession -> taxID info (or memory-map index)
+  if isIndex(args[2]):
+    acc2tax = AccIndex(args[2])
+  else:
+    fAcc = openRead(args[2])
+    acc2tax = loadAcc(fAcc)
+    if fAcc != sys.stdin:
+      fAcc.close()
 
   # print output
   fIn = openRead(args[3])
   fOut = openWrite(args[4])
-  count, short, xReads, total = parseFasta(fIn, fOut, taxa, acc2tax)
+  count, short, xReads, total = parseFasta(fIn, fOut, taxa, acc2tax, \
+    procs)
   if fIn != sys.stdin:
     fIn.close()
   if fOut != sys.stdout:
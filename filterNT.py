@@ -10,109 +10,236 @@
 #       given list
 
 import sys
-import gzip
+import multiprocessing
+import collections
+import array
+import bisect
+import heapq
+from gzipIO import openRead, openWrite
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
-def openRead(filename):
+BLOCK = 16 * 1024 * 1024  # bytes of fasta filtered at once
+HASHMASK = (1 << 63) - 1  # keep header hashes non-negative
+CHUNK = 1000000           # hashes sorted at once (without numpy)
+
+def sortUnique(hashes):
   '''
-  Open filename for reading. '-' indicates stdin.
-    '.gz' suffix indicates gzip compression.
+  Sort an array of hashes in place, dropping duplicates,
+    without converting it to a list of Python ints: with
+    numpy if available, otherwise by sorting chunks of
+    CHUNK hashes and merging them into a new array.
   '''
-  if filename == '-':
-    return sys.stdin
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'rb')
-    else:
-      f = open(filename, 'rU')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for reading\n' % filename)
-    sys.exit(-1)
-  return f
+  n = len(hashes)
+  if numpy != None:
+    a = numpy.frombuffer(hashes, dtype='l')
+    a.sort()
+    if n:
+      keep = numpy.empty(n, dtype=bool)
+      keep[0] = True
+      numpy.not_equal(a[1:], a[:-1], keep[1:])
+      u = a[keep]
+      del keep
+      n = len(u)
+      a[:n] = u
+      del u
+    del a  # (before resizing hashes)
+    del hashes[n:]
+    return hashes
+
+  for i in xrange(0, n, CHUNK):
+    hashes[i:i+CHUNK] = array.array('l', sorted(hashes[i:i+CHUNK]))
+  chunks = [(hashes[j] for j in xrange(i, min(i + CHUNK, n))) \
+    for i in xrange(0, n, CHUNK)]
+  res = array.array('l')
+  prev = -1
+  for h in heapq.merge(*chunks):
+    if h != prev:
+      res.append(h)
+      prev = h
+  return res
 
-def openWrite(filename):
+class HeaderSet:
   '''
-  Open filename for writing. '-' indicates stdout.
-    '.gz' suffix indicates gzip compression.
+  HeaderSet: compact, read-only set of headers.
+    Stores a sorted array of 63-bit header hashes, plus
+    a table of offsets into it for buckets defined by
+    the top bits of the hash, so each membership test is
+    a short binary search (O(1) expected). Distinct headers
+    may collide (with probability ~ n / 2**63 per test).
   '''
-  if filename == '-':
-    return sys.stdout
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'wb')
-    else:
-      f = open(filename, 'w')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for writing\n' % filename)
-    sys.exit(-1)
-  return f
+  def __init__(self, hashes):
+    self.hashes = sortUnique(hashes)
+    bits = max(len(self.hashes).bit_length() - 3, 0)
+    self.shift = 63 - bits
+    self.offsets = array.array('l', (bisect.bisect_left(self.hashes, \
+      b << self.shift) for b in xrange((1 << bits) + 1)))
+
+  def __len__(self):
+    return len(self.hashes)
+
+  def __contains__(self, head):
+    h = hash(head) & HASHMASK
+    b = h >> self.shift
+    hi = self.offsets[b+1]
+    i = bisect.bisect_left(self.hashes, h, self.offsets[b], hi)
+    return i < hi and self.hashes[i] == h
+
+def loadHeaders(f, compact):
+  '''
+  Load headers of seqs to exclude, to a set
+    (or a HeaderSet, if compact).
+  '''
+  if compact:
+    return HeaderSet(array.array('l', (hash(line.rstrip()) & HASHMASK \
+      for line in f)))
+  return set(line.rstrip() for line in f)
+
+def readBlocks(fIn, size=BLOCK):
+  '''
+  Generate blocks of a fasta file (of about size bytes),
+    each ending at a record boundary.
+  '''
+  rest = ''  # partial record from end of previous block
+  while True:
+    block = fIn.read(size)
+    if not block:
+      break
+    block = rest + block
+    i = block.rfind('\n>')
+    if i == -1:
+      rest = block
+      continue
+    yield block[:i+1]
+    rest = block[i+1:]
+  if rest:
+    yield rest
+
+def initFilter(minLen, headers):
+  '''
+  Save filtering criteria for filterBlock() (in each process).
+  '''
+  global filterArgs
+  filterArgs = (minLen, headers)
+
+def pureN(seq):
+  '''
+  Determine if a sequence (lines) is pure Ns,
+    without building any strings (1st char checked
+    first, to reject most sequences at once).
+  '''
+  return seq[:1] in 'N\n' \
+    and seq.count('N') + seq.count('\n') == len(seq)
 
-def parseFasta(fIn, fOut, minLen, headers):
+def filterBlock(block):
   '''
-  Parse fasta file, write output on the fly.
+  Filter the fasta records in a block. Records to keep are
+    copied as slices of the block (consecutive ones as one
+    slice). Return output and counts.
   '''
+  minLen, headers = filterArgs
   count = short = pureNs = xReads = total = 0
-  head = ''    # header (1st space-delim token)
-  read = ''    # full read (header + sequence)
-  nseq = True  # sequence is pure Ns
-  length = 0   # length of sequence
-
-  # analyze fasta reads
-  for line in fIn:
-    if line[0] == '>':
-
-      # process previous read
-      if read:
-        count += 1
-        if length < minLen:
-          short += 1
-        elif nseq:
-          pureNs += 1
-        elif head in headers:
-          xReads += 1
-        else:
-          fOut.write(read)
-          total += 1
-
-      # start new read
-      read = line
-      head = line.split(' ')[0][1:]
-      length = 0
-      nseq = True
-
-    elif read:
-      # save sequence
-      read += line
-      length += len(line) - 1
-      if line.rstrip() != 'N' * (len(line) - 1):
-        nseq = False
+  out = []
+  keep = 0   # start of records kept (not yet saved)
+  start = 0  # start of record
+  while start < len(block):
+    end = block.find('\n>', start) + 1
+    if end == 0:
+      end = len(block)
+    if block[start] != '>':
+      # skip text before 1st header
+      out.append(block[keep:start])
+      start = keep = end
+      continue
 
-  if fIn != sys.stdin:
-    fIn.close()
+    # find header (1st space-delim token) and sequence length
+    eol = block.find('\n', start, end)
+    if eol == -1:
+      eol = end
+    head = block[start+1:eol].rstrip().split(' ')[0]
+    seq = block[eol+1:end]
+    length = len(seq) - seq.count('\n')
 
-  # process last read
-  if read:
     count += 1
     if length < minLen:
       short += 1
-    elif nseq:
+    elif pureN(seq):
       pureNs += 1
     elif head in headers:
       xReads += 1
     else:
-      fOut.write(read)
       total += 1
+      start = end
+      continue
+    out.append(block[keep:start])
+    start = keep = end
+
+  out.append(block[keep:])
+  return ''.join(out), (count, short, pureNs, xReads, total)
+
+def poolBlocks(pool, procs, blocks):
+  '''
+  Generate results of blocks filtered by the pool,
+    in input order, with at most 2*procs pending.
+  '''
+  pending = collections.deque()
+  for block in blocks:
+    pending.append(pool.apply_async(filterBlock, (block,)))
+    if len(pending) > 2 * procs:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def parseFasta(fIn, fOut, minLen, headers, procs=1):
+  '''
+  Parse fasta file in blocks, write output on the fly.
+    Blocks are filtered by a pool of worker processes
+    if procs > 1, with output written in input order.
+  '''
+  stats = [0, 0, 0, 0, 0]  # count, short, pureNs, xReads, total
+  initFilter(minLen, headers)
+  if procs < 2:
+    results = (filterBlock(block) for block in readBlocks(fIn))
+  else:
+    pool = multiprocessing.Pool(procs, initFilter, (minLen, headers))
+    results = poolBlocks(pool, procs, readBlocks(fIn))
+  for out, counts in results:
+    fOut.write(out)
+    for i in xrange(len(stats)):
+      stats[i] += counts[i]
+  if procs >= 2:
+    pool.close()
+    pool.join()
 
+  if fIn != sys.stdin:
+    fIn.close()
   if fOut != sys.stdout:
     fOut.close()
 
-  return count, short, pureNs, xReads, total
+  return tuple(stats)
 
 def main():
   '''Main.'''
   args = sys.argv[1:]
+  procs = 1        # number of worker processes
+  compact = False  # store headers as a HeaderSet
+  while args and args[0] in ['-p', '-c']:
+    if args[0] == '-c':
+      compact = True
+      args = args[1:]
+    elif len(args) > 1:
+      procs = int(args[1])
+      args = args[2:]
+    else:
+      args = []
   if len(args) < 2:
-    sys.stderr.write('Usage: python filterNT.py  <input>  ' \
-      + '<output>  [<minLen>]  [<headers]\n')
+    sys.stderr.write('Usage: python filterNT.py  [-p <int>]  [-c]  ' \
+      + '<input>  <output>  [<minLen>]  [<headers]\n')
+    sys.stderr.write('  -p <int>    Number of worker processes (def. 1)\n')
+    sys.stderr.write('  -c          Store headers compactly (hashes; ' \
+      + 'for millions of headers)\n')
     sys.stderr.write('  <minLen>    Minimum sequence length (def. 25bp)\n')
     sys.stderr.write('  <headers>   File listing headers of sequences to exclude\n')
     sys.exit(-1)
@@ -125,15 +252,16 @@ def main():
     minLen = int(args[2])
 
   # load headers of seqs to exclude
-  headers = []
+  headers = set()
   if len(args) > 3:
     fRead = openRead(args[3])
-    for line in fRead:
-      headers.append(line.rstrip())
+    headers = loadHeaders(fRead, compact)
+    if fRead != sys.stdin:
+      fRead.close()
 
   # parse fasta
   count, short, pureNs, xReads, total \
-    = parseFasta(fIn, fOut, minLen, headers)
+    = parseFasta(fIn, fOut, minLen, headers, procs)
 
   sys.stderr.write('Total fasta sequences in %s: %d\n' % (args[0], count))
   sys.stderr.write('  Shorter than %dbp: %d\n' % (minLen, short))
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+# File I/O shared by the throughput-bound scripts
+#   (retrieveReads, mergeSplit, filterNT, excludeTaxa).
+#   Gzip (de)compression runs alongside the script:
+#   - in an external pigz/igzip process, if available
+#   - otherwise in background threads (zlib releases
+#       the GIL while inflating/deflating)
+
+import sys
+import gzip
+import zlib
+import subprocess
+import threading
+import Queue
+import collections
+import multiprocessing
+import multiprocessing.pool
+from distutils.spawn import find_executable
+
+GZLEVEL = 9              # def. gzip compression level for outputs
+ZBLOCK = 1024 * 1024     # bytes (de)compressed per block
+AHEAD = 16               # blocks decompressed ahead of the reader
+PIGZ = find_executable('pigz')             # multi-threaded gzip
+UNZIP = PIGZ or find_executable('igzip')   # for decompression
+
+class PigzWriter:
+  '''
+  PigzWriter: file-like writer that compresses via
+    an external pigz process (multi-threaded).
+  '''
+  def __init__(self, filename, level, threads):
+    self.f = open(filename, 'wb')
+    self.proc = subprocess.Popen([PIGZ, '-c', '-%d' % level, \
+      '-p', str(threads)], stdin=subprocess.PIPE, stdout=self.f)
+    self.write = self.proc.stdin.write
+
+  def close(self):
+    self.proc.stdin.close()
+    if self.proc.wait():
+      sys.stderr.write('Error! Cannot compress output\n')
+      sys.exit(-1)
+    self.f.close()
+
+class PigzReader:
+  '''
+  PigzReader: file-like reader that decompresses via
+    an external pigz/igzip process (reading ahead of
+    the script). Its exit status is checked on close(),
+    if the input was read to the end, so a corrupt or
+    truncated file is an error rather than an early EOF.
+  '''
+  def __init__(self, filename):
+    self.filename = filename
+    self.proc = subprocess.Popen([UNZIP, '-dc', filename], \
+      stdout=subprocess.PIPE, bufsize=-1)
+    self.f = self.proc.stdout
+    self.eof = False
+
+  def read(self, size=-1):
+    data = self.f.read(size)
+    if not data or size < 0:
+      self.eof = True
+    return data
+
+  def readline(self):
+    line = self.f.readline()
+    if not line:
+      self.eof = True
+    return line
+
+  def __iter__(self):
+    for line in self.f:
+      yield line
+    self.eof = True
+
+  def close(self):
+    if not self.eof:
+      self.proc.kill()  # stopped early: error not expected
+    self.f.close()
+    if self.proc.wait() and self.eof:
+      sys.stderr.write('Error! Cannot decompress %s\n' % self.filename)
+      sys.exit(-1)
+
+class ThreadReader:
+  '''
+  ThreadReader: file-like reader that decompresses a
+    gzip file in a background thread, up to AHEAD blocks
+    ahead of the script. The thread is started on the
+    first read (so the script may fork before then).
+  '''
+  def __init__(self, filename):
+    self.filename = filename
+    self.gz = gzip.open(filename, 'rb')
+    self.q = Queue.Queue(AHEAD)
+    self.thread = None
+    self.stop = False  # set by close(): thread should exit
+    self.done = False  # last (empty) block received
+    self.buf = ''      # decompressed data not yet returned
+    self.pos = 0       # position in buf
+
+  def inflate(self):
+    '''Decompress blocks onto the queue (thread target).'''
+    try:
+      while not self.stop:
+        block = self.gz.read(ZBLOCK)
+        self.q.put(block)
+        if not block:
+          break
+    except Exception as e:
+      self.q.put(e)
+
+  def nextBlock(self):
+    '''Return the next decompressed block ('' at EOF).'''
+    if self.done:
+      return ''
+    if self.thread == None:
+      self.thread = threading.Thread(target=self.inflate)
+      self.thread.daemon = True
+      self.thread.start()
+    block = self.q.get()
+    if isinstance(block, Exception):
+      sys.stderr.write('Error! Cannot decompress %s: %s\n' \
+        % (self.filename, block))
+      sys.exit(-1)
+    if not block:
+      self.done = True
+    return block
+
+  def read(self, size=-1):
+    parts = [self.buf[self.pos:]]
+    total = len(parts[0])
+    while size < 0 or total < size:
+      block = self.nextBlock()
+      if not block:
+        break
+      parts.append(block)
+      total += len(block)
+    data = ''.join(parts)
+    if size < 0 or total <= size:
+      self.buf = ''
+      self.pos = 0
+      return data
+    self.buf = data
+    self.pos = size
+    return data[:size]
+
+  def readline(self):
+    i = self.buf.find('\n', self.pos)
+    while i == -1:
+      block = self.nextBlock()
+      if not block:
+        line = self.buf[self.pos:]
+        self.buf = ''
+        self.pos = 0
+        return line
+      self.buf = self.buf[self.pos:] + block
+      self.pos = 0
+      i = self.buf.find('\n')
+    line = self.buf[self.pos:i+1]
+    self.pos = i + 1
+    return line
+
+  def __iter__(self):
+    rest = self.buf[self.pos:]  # partial line from previous block
+    self.buf = ''
+    self.pos = 0
+    while True:
+      block = self.nextBlock()
+      if not block:
+        break
+      lines = (rest + block).split('\n')
+      rest = lines.pop()
+      for line in lines:
+        yield line + '\n'
+    if rest:
+      yield rest
+
+  def close(self):
+    self.stop = True
+    if self.thread != None:
+      # unblock the thread, if waiting on a full queue
+      while self.thread.is_alive():
+        try:
+          self.q.get(True, 0.1)
+        except Queue.Empty:
+          pass
+      self.thread.join()
+    self.gz.close()
+
+def compressBlock(data, level):
+  '''
+  Compress data as one gzip member.
+  '''
+  z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return z.compress(data) + z.flush()
+
+class ThreadWriter:
+  '''
+  ThreadWriter: file-like writer that compresses blocks
+    of output in a pool of threads. Each block is its own
+    gzip member (a concatenation of members is a valid
+    gzip file); members are written in order.
+  '''
+  def __init__(self, filename, level, threads):
+    self.f = open(filename, 'wb')
+    self.level = level
+    self.threads = threads
+    self.pool = None     # started on the first full block
+    self.pending = collections.deque()  # blocks being compressed
+    self.parts = []      # output not yet sent to the pool
+    self.size = 0        # bytes in parts
+    self.blocks = 0      # blocks sent to the pool
+
+  def write(self, data):
+    self.parts.append(data)
+    self.size += len(data)
+    if self.size >= ZBLOCK:
+      self.submit()
+
+  def submit(self):
+    '''Send buffered output to the pool for compression.'''
+    if self.pool == None:
+      self.pool = multiprocessing.pool.ThreadPool(self.threads)
+    self.pending.append(self.pool.apply_async(compressBlock, \
+      (''.join(self.parts), self.level)))
+    self.parts = []
+    self.size = 0
+    self.blocks += 1
+    while len(self.pending) > 2 * self.threads:
+      self.f.write(self.pending.popleft().get())
+
+  def close(self):
+    if self.parts or not self.blocks:
+      self.submit()  # (empty output is still a valid gzip file)
+    while self.pending:
+      self.f.write(self.pending.popleft().get())
+    self.pool.close()
+    self.pool.join()
+    self.f.close()
+
+def openRead(filename):
+  '''
+  Open filename for reading. '-' indicates stdin.
+    '.gz' suffix indicates gzip compression (decompressed
+    ahead, by an external pigz/igzip process if available,
+    otherwise in a background thread).
+  '''
+  if filename == '-':
+    return sys.stdin
+  try:
+    if filename[-3:] == '.gz':
+      if UNZIP:
+        open(filename, 'rb').close()  # check readability
+        f = PigzReader(filename)
+      else:
+        f = ThreadReader(filename)
+    else:
+      f = open(filename, 'rU')
+  except IOError:
+    sys.stderr.write('Error! Cannot open %s for reading\n' % filename)
+    sys.exit(-1)
+  return f
+
+def openWrite(filename, level=GZLEVEL):
+  '''
+  Open filename for writing. '-' indicates stdout.
+    '.gz' suffix indicates gzip compression (at given
+    level; multi-threaded, via pigz if available).
+  '''
+  if filename == '-':
+    return sys.stdout
+  try:
+    if filename[-3:] == '.gz':
+      threads = multiprocessing.cpu_count()
+      if PIGZ:
+        f = PigzWriter(filename, level, threads)
+      else:
+        f = ThreadWriter(filename, level, threads)
+    else:
+      f = open(filename, 'w')
+  except IOError:
+    sys.stderr.write('Error! Cannot open %s for writing\n' % filename)
+    sys.exit(-1)
+  return f
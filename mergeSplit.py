@@ -7,99 +7,149 @@
 #   - write them out to separate outputs
 
 import sys
-import gzip
+import itertools
+import tempfile
+from gzipIO import openRead, openWrite
 
-def openRead(filename):
+BLOCK = 4 * 1024 * 1024  # bytes read per fastq block
+MAXBUF = 1000000         # def. reads buffered awaiting their mates
+NPART = 16               # temp files per input for spilled reads
+
+def readFastq(f, size=BLOCK):
   '''
-  Open filename for reading. '-' indicates stdin.
-    '.gz' suffix indicates gzip compression.
+  Generate records from a fastq file, read in large blocks
+    that are split into lines in one pass. Each record is
+    (name, head, seq, plus, qual): name is the read name
+    (1st space-delim token of the header, without '@'),
+    followed by the record's four lines (without newlines).
   '''
-  if filename == '-':
-    return sys.stdin
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'rb')
-    else:
-      f = open(filename, 'rU')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for reading\n' % filename)
-    sys.exit(-1)
-  return f
+  rest = ''  # partial record from end of previous block
+  while True:
+    block = f.read(size)
+    if not block:
+      break
+    lines = (rest + block).split('\n')
+    n = (len(lines) - 1) // 4 * 4  # lines of complete records
+    rest = '\n'.join(lines[n:])
+    it = itertools.islice(lines, n)
+    for head, seq, plus, qual in itertools.izip(it, it, it, it):
+      if head[:1] != '@':
+        if not (head or seq or plus or qual):
+          continue  # blank lines (e.g. at the end of the file)
+        sys.stderr.write('Error! Not FASTQ format\n')
+        sys.exit(-1)
+      yield head.split(' ', 1)[0][1:].rstrip(), head, seq, plus, qual
+
+  # last record (lacking a final newline)
+  rest = rest.rstrip('\n')  # (ignoring trailing blank lines)
+  if rest:
+    lines = rest.split('\n')
+    if len(lines) != 4 or lines[0][:1] != '@':
+      sys.stderr.write('Error! Not FASTQ format\n')
+      sys.exit(-1)
+    yield lines[0].split(' ', 1)[0][1:].rstrip(), \
+      lines[0], lines[1], lines[2], lines[3]
 
-def openWrite(filename):
+def spill(parts, pend):
   '''
-  Open filename for writing. '-' indicates stdout.
-    '.gz' suffix indicates gzip compression.
+  Write buffered reads to temp files, partitioned
+    by hash of read name.
   '''
-  if filename == '-':
-    return sys.stdout
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'wb')
-    else:
-      f = open(filename, 'w')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for writing\n' % filename)
-    sys.exit(-1)
-  return f
+  for key in pend:
+    parts[hash(key) % NPART].write('\n'.join(pend[key]) + '\n')
+  pend.clear()
+
+def syncPairs(fIn1, fIn2, fOut1, fOut2, maxBuf):
+  '''
+  Stream both inputs in parallel, writing each pair of reads
+    as soon as both ends are seen. Reads awaiting their mates
+    are buffered; past maxBuf reads, the buffers are spilled
+    to disk, and those reads are matched at the end, one
+    partition at a time.
+  '''
+  pend1 = dict()  # reads from 1st input awaiting mates
+  pend2 = dict()  # reads from 2nd input awaiting mates
+  parts1 = parts2 = None
+  count = spilled = 0
+  for r1, r2 in itertools.izip_longest(readFastq(fIn1), readFastq(fIn2)):
+    if r1:
+      rec = (r1[1].rstrip(), r1[2].rstrip(), '+', r1[4].rstrip())
+      if r1[0] in pend2:
+        fOut1.write('\n'.join(rec) + '\n')
+        fOut2.write('\n'.join(pend2.pop(r1[0])) + '\n')
+        count += 1
+      else:
+        pend1[r1[0]] = rec
+    if r2:
+      rec = (r2[1].rstrip(), r2[2].rstrip(), '+', r2[4].rstrip())
+      if r2[0] in pend1:
+        fOut1.write('\n'.join(pend1.pop(r2[0])) + '\n')
+        fOut2.write('\n'.join(rec) + '\n')
+        count += 1
+      else:
+        pend2[r2[0]] = rec
+
+    # spill buffers to disk if too large
+    if len(pend1) + len(pend2) > maxBuf:
+      if parts1 == None:
+        parts1 = [tempfile.TemporaryFile() for i in xrange(NPART)]
+        parts2 = [tempfile.TemporaryFile() for i in xrange(NPART)]
+      spilled += len(pend1) + len(pend2)
+      spill(parts1, pend1)
+      spill(parts2, pend2)
+
+  # match spilled reads (with those still buffered)
+  if parts1 != None:
+    spill(parts1, pend1)
+    spill(parts2, pend2)
+    for p1, p2 in zip(parts1, parts2):
+      p1.seek(0)
+      p2.seek(0)
+      d = dict()
+      for key, head, seq, plus, qual in readFastq(p1):
+        d[key] = (head, seq, plus, qual)
+      for key, head, seq, plus, qual in readFastq(p2):
+        if key in d:
+          fOut1.write('\n'.join(d.pop(key)) + '\n')
+          fOut2.write('\n'.join([head, seq, plus, qual]) + '\n')
+          count += 1
+      p1.close()
+      p2.close()
+
+  return count, spilled
 
 def main():
   args = sys.argv[1:]
   if len(args) < 4:
     sys.stderr.write('Usage: python mergeSplit.py  ' \
-      + '<inFQ1> <inFQ2>  <outFQ1> <outFQ2>\n')
+      + '<inFQ1> <inFQ2>  <outFQ1> <outFQ2>  [<maxBuf>]\n')
+    sys.stderr.write('  <maxBuf>   Max. reads held in memory awaiting ' \
+      + 'their mates (def. %d)\n' % MAXBUF)
     sys.exit(-1)
 
-  # open SAM file
+  # open fastq files
   fIn1 = openRead(args[0])
   fIn2 = openRead(args[1])
   fOut1 = openWrite(args[2])
   fOut2 = openWrite(args[3])
+  maxBuf = MAXBUF
+  if len(args) > 4:
+    maxBuf = int(args[4])
+
+  # write reads found in both inputs
+  count, spilled = syncPairs(fIn1, fIn2, fOut1, fOut2, maxBuf)
+  sys.stderr.write('Reads written: %d\n' % count)
+  if spilled:
+    sys.stderr.write('  (spilled to disk: %d)\n' % spilled)
 
-  # load reads from 1st input file
-  d = dict()
-  flag = True
-  while flag:
-    head = seq = qual = ''
-    for i in range(4):
-      line = fIn1.readline().rstrip()
-      if not line:
-        flag = False
-        break
-      if i == 0:
-        head = line
-      elif i == 1:
-        seq = line
-      elif i == 3:
-        qual = line
-    if flag:
-      key = head.split(' ')[0][1:]
-      d[key] = (head, seq, '+', qual)
   if fIn1 != sys.stdin:
     fIn1.close()
-
-  # check reads in 2nd input, write out both
-  #   if there's a match
-  flag = True
-  while flag:
-    head = seq = qual = ''
-    for i in range(4):
-      line = fIn2.readline().rstrip()
-      if not line:
-        flag = False
-        break
-      if i == 0:
-        head = line
-      elif i == 1:
-        seq = line
-      elif i == 3:
-        qual = line
-    if flag:
-      key = head.split(' ')[0][1:]
-      if key in d:
-        fOut1.write('\n'.join(d[key]) + '\n')
-        fOut2.write('\n'.join([head, seq, '+', qual]) + '\n')
-        #sys.exit(0)
+  if fIn2 != sys.stdin:
+    fIn2.close()
+  if fOut1 != sys.stdout:
+    fOut1.close()
+  if fOut2 != sys.stdout:
+    fOut2.close()
 
 if __name__ == '__main__':
   main()
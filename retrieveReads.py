@@ -7,57 +7,156 @@
 #   - copy those reads from fastq files to output fastq files
 
 import sys
-import gzip
+import multiprocessing
+import array
+import bisect
+import itertools
+import time
+import heapq
+from gzipIO import openRead, openWrite
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
-def openRead(filename):
+HASHMASK = (1 << 63) - 1  # keep header hashes non-negative
+BLOCK = 4 * 1024 * 1024   # bytes read per fastq block
+WAIT = 1                  # seconds between checks of child processes
+CHUNK = 1000000           # hashes sorted at once (without numpy)
+
+def readFastq(f, size=BLOCK):
   '''
-  Open filename for reading. '-' indicates stdin.
-    '.gz' suffix indicates gzip compression.
+  Generate records from a fastq file, read in large blocks
+    that are split into lines in one pass. Each record is
+    (name, head, seq, plus, qual): name is the read name
+    (1st space-delim token of the header, without '@'),
+    followed by the record's four lines (without newlines).
   '''
-  if filename == '-':
-    return sys.stdin
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'rb')
-    else:
-      f = open(filename, 'rU')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for reading\n' % filename)
-    sys.exit(-1)
-  return f
+  rest = ''  # partial record from end of previous block
+  while True:
+    block = f.read(size)
+    if not block:
+      break
+    lines = (rest + block).split('\n')
+    n = (len(lines) - 1) // 4 * 4  # lines of complete records
+    rest = '\n'.join(lines[n:])
+    it = itertools.islice(lines, n)
+    for head, seq, plus, qual in itertools.izip(it, it, it, it):
+      if head[:1] != '@':
+        if not (head or seq or plus or qual):
+          continue  # blank lines (e.g. at the end of the file)
+        sys.stderr.write('Error! Not FASTQ format\n')
+        sys.exit(-1)
+      yield head.split(' ', 1)[0][1:].rstrip(), head, seq, plus, qual
+
+  # last record (lacking a final newline)
+  rest = rest.rstrip('\n')  # (ignoring trailing blank lines)
+  if rest:
+    lines = rest.split('\n')
+    if len(lines) != 4 or lines[0][:1] != '@':
+      sys.stderr.write('Error! Not FASTQ format\n')
+      sys.exit(-1)
+    yield lines[0].split(' ', 1)[0][1:].rstrip(), \
+      lines[0], lines[1], lines[2], lines[3]
 
-def openWrite(filename):
+def sortUnique(hashes):
   '''
-  Open filename for writing. '-' indicates stdout.
-    '.gz' suffix indicates gzip compression.
+  Sort an array of hashes in place, dropping duplicates,
+    without converting it to a list of Python ints: with
+    numpy if available, otherwise by sorting chunks of
+    CHUNK hashes and merging them into a new array.
   '''
-  if filename == '-':
-    return sys.stdout
-  try:
-    if filename[-3:] == '.gz':
-      f = gzip.open(filename, 'wb')
-    else:
-      f = open(filename, 'w')
-  except IOError:
-    sys.stderr.write('Error! Cannot open %s for writing\n' % filename)
-    sys.exit(-1)
-  return f
+  n = len(hashes)
+  if numpy != None:
+    a = numpy.frombuffer(hashes, dtype='l')
+    a.sort()
+    if n:
+      keep = numpy.empty(n, dtype=bool)
+      keep[0] = True
+      numpy.not_equal(a[1:], a[:-1], keep[1:])
+      u = a[keep]
+      del keep
+      n = len(u)
+      a[:n] = u
+      del u
+    del a  # (before resizing hashes)
+    del hashes[n:]
+    return hashes
+
+  for i in xrange(0, n, CHUNK):
+    hashes[i:i+CHUNK] = array.array('l', sorted(hashes[i:i+CHUNK]))
+  chunks = [(hashes[j] for j in xrange(i, min(i + CHUNK, n))) \
+    for i in xrange(0, n, CHUNK)]
+  res = array.array('l')
+  prev = -1
+  for h in heapq.merge(*chunks):
+    if h != prev:
+      res.append(h)
+      prev = h
+  return res
+
+class HeaderSet:
+  '''
+  HeaderSet: compact, read-only set of read headers.
+    Stores a sorted array of 63-bit header hashes, plus
+    a table of offsets into it for buckets defined by
+    the top bits of the hash, so each membership test is
+    a short binary search (O(1) expected). Distinct headers
+    may collide (with probability ~ n / 2**63 per test).
+  '''
+  def __init__(self, hashes):
+    self.hashes = sortUnique(hashes)
+    bits = max(len(self.hashes).bit_length() - 3, 0)
+    self.shift = 63 - bits
+    self.offsets = array.array('l', (bisect.bisect_left(self.hashes, \
+      b << self.shift) for b in xrange((1 << bits) + 1)))
+
+  def __len__(self):
+    return len(self.hashes)
+
+  def __contains__(self, head):
+    h = hash(head) & HASHMASK
+    b = h >> self.shift
+    hi = self.offsets[b+1]
+    i = bisect.bisect_left(self.hashes, h, self.offsets[b], hi)
+    return i < hi and self.hashes[i] == h
 
 def loadReads(f):
   '''
   Load read headers for aligned reads.
   '''
-  d = dict()
-  #count = 0
+  start = time.time()
+  hashes = array.array('l')
   for line in f:
     if line[0] == '@': continue
     spl = line.rstrip().split('\t')
     if len(spl) < 11: continue
-    d[spl[0]] = 1
-    #count += 1
-  sys.stderr.write('Reads loaded: %d\n' % len(d))
+    hashes.append(hash(spl[0]) & HASHMASK)
+  d = HeaderSet(hashes)
+  sys.stderr.write('Reads loaded: %d (%.1fs)\n' % (len(d), time.time() - start))
   return d
 
+def filterReads(inFile, outFile, d, q=None):
+  '''
+  Copy reads whose headers are in d from a fastq file to
+    the output. Return (or put on queue q) the counts.
+  '''
+  fIn = openRead(inFile)
+  fOut = openWrite(outFile)
+  total = count = 0
+  for name, head, seq, plus, qual in readFastq(fIn):
+    total += 1
+    if name in d:
+      fOut.write('\n'.join([head, seq, plus, qual]) + '\n')
+      count += 1
+  if fIn != sys.stdin:
+    fIn.close()
+  if fOut != sys.stdout:
+    fOut.close()
+  if q != None:
+    q.put((inFile, total, count))
+  return inFile, total, count
+
 def main():
   args = sys.argv[1:]
   if len(args) < 5:
@@ -71,63 +170,36 @@ def main():
   if fIn != sys.stdin:
     fIn.close()
 
-  # open fastq files
-  fIn1 = openRead(args[1])
-  fIn2 = openRead(args[2])
-  fOut1 = openWrite(args[3])
-  fOut2 = openWrite(args[4])
+  # check reads from both fastq files
+  if '-' in args[1:5]:
+    # stdin is not available to child processes, and
+    #   stdout cannot be shared by them
+    res = [filterReads(args[1], args[3], d), \
+      filterReads(args[2], args[4], d)]
+  else:
+    # one process per fastq file, sharing d (via fork)
+    q = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=filterReads, \
+      args=(args[i], args[i+2], d, q)) for i in [1, 2]]
+    for p in procs:
+      p.start()
+    # wait for both (stopping the other, if one fails)
+    live = procs
+    while live and not [p for p in procs if p.exitcode]:
+      live[0].join(WAIT)
+      live = [p for p in live if p.is_alive()]
+    for p in procs:
+      if p.is_alive():
+        p.terminate()
+      p.join()
+    if [p for p in procs if p.exitcode]:
+      sys.exit(-1)
+    res = sorted([q.get() for p in procs], \
+      key=lambda r: args.index(r[0]))
 
-  # check reads from 1st input file
-  total = count = 0
-  flag = True
-  while flag:
-    match = False
-    for i in range(4):
-      line = fIn1.readline()
-      if not line:
-        flag = False
-        break
-      if i == 0:
-        if line.split(' ')[0][1:].rstrip() in d:
-          match = True
-      if match:
-        fOut1.write(line)
-    if flag:
-      total += 1
-      if match:
-        count += 1
-  if fIn1 != sys.stdin:
-    fIn1.close()
-  if fOut1 != sys.stdout:
-    fOut1.close()
-  sys.stderr.write('Reads in %s: %d\n' % (args[1], total))
-  sys.stderr.write('  printed: %d\n' % count)
-
-  # check reads from 2nd input file
-  total = count = 0
-  flag = True
-  while flag:
-    match = False
-    for i in range(4):
-      line = fIn2.readline()
-      if not line:
-        flag = False
-        break
-      if i == 0:
-        if line.split(' ')[0][1:].rstrip() in d:
-          match = True
-      if match:
-        fOut2.write(line)
-    if flag:
-      total += 1
-      if match:
-        count += 1
-  if fIn2 != sys.stdin:
-    fIn2.close()
-  if fOut2 != sys.stdout:
-    fOut2.close()
-  sys.stderr.write('Reads in %s: %d\n' % (args[2], total))
-  sys.stderr.write('  printed: %d\n' % count)
+  for inFile, total, count in res:
+    sys.stderr.write('Reads in %s: %d\n' % (inFile, total))
+    sys.stderr.write('  printed: %d\n' % count)
 
 if __name__ == '__main__':
   main()
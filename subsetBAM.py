@@ -4,24 +4,37 @@
 
 # output a FASTQ of reads in a SAM whose barcodes match
 #   those in a given file
+#   (or, with -g, one FASTQ per group of barcodes)
 
 import sys
+import os
+import time
+import string
+import array
+import itertools
+import collections
+try:
+  import pysam
+except ImportError:
+  pysam = None
+
+# complements of DNA (IUPAC) codes, for revComp()
+DNA = 'ACGTRYKMSWBDHVNacgtrykmswbdhvn'
+COMP = string.maketrans(DNA, 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn')
+NONDNA = ''.join([chr(i) for i in xrange(256) if chr(i) not in DNA])
+
+BUFSIZE = 1024 * 1024  # bytes buffered per group before writing
+MAXOPEN = 100          # def. max. output files open at once
 
 def revComp(dna):
   '''
-  Reverse-complement the given DNA sequence.
+  Reverse-complement the given DNA sequence
+    (IUPAC codes, upper or lower case).
   '''
-  rc = ''
-  for nuc in dna[::-1]:
-    comp = ''
-    if nuc == 'A': comp = 'T'
-    elif nuc == 'C': comp = 'G'
-    elif nuc == 'G': comp = 'C'
-    elif nuc == 'T': comp = 'A'
-    elif nuc == 'N': comp = 'N'
-    else:
+  rc = dna[::-1].translate(COMP, NONDNA)
+  if len(rc) != len(dna):
+    for nuc in dna.translate(None, DNA):
       print 'Error! Unknown nucleotide: %s' % nuc
-    rc += comp
   return rc
 
 def getTag(tag, lis):
@@ -36,6 +49,94 @@ def getTag(tag, lis):
   #sys.stderr.write('Error! Cannot find %s in SAM record\n' % tag)
   #sys.exit(-1)
 
+def samRecords(lines):
+  '''
+  Generate (read, flag, seq, qual, barcode) from SAM records.
+  '''
+  for line in lines:
+    if line[0] == '@': continue
+    spl = line.rstrip().split('\t')
+    yield spl[0], int(spl[1]), spl[9], spl[10], getTag('CB', spl[11:])
+
+def bamRecord(r):
+  '''
+  Convert a BAM record (pysam) to (read, flag, seq, qual, barcode),
+    taking the CB tag from the binary record.
+  '''
+  qual = r.query_qualities
+  return r.query_name, r.flag, r.query_sequence or '*', \
+    pysam.qualities_to_qualitystring(qual) if qual != None else '*', \
+    r.get_tag('CB') if r.has_tag('CB') else None
+
+def bamRecords(bam):
+  '''
+  Generate (read, flag, seq, qual, barcode) from BAM records.
+  '''
+  for r in bam.fetch(until_eof=True):
+    yield bamRecord(r)
+
+def buildIndex(bam, bamFile):
+  '''
+  Build a barcode index of a BAM: '<BAM>.cbo' holds the
+    records' virtual offsets (int64), grouped by barcode, and
+    '<BAM>.cbi' lists each barcode with the start and count
+    of its offsets.
+  '''
+  d = dict()  # barcode -> offsets
+  while True:
+    off = bam.tell()
+    try:
+      r = next(bam)
+    except StopIteration:
+      break
+    if r.has_tag('CB'):
+      barcode = r.get_tag('CB').split('-')[0]
+      if barcode not in d:
+        d[barcode] = array.array('l')
+      d[barcode].append(off)
+
+  fOff = open(bamFile + '.cbo', 'wb')
+  fIdx = open(bamFile + '.cbi', 'w')
+  start = 0
+  for barcode in sorted(d):
+    d[barcode].tofile(fOff)
+    fIdx.write('%s\t%d\t%d\n' % (barcode, start, len(d[barcode])))
+    start += len(d[barcode])
+  fOff.close()
+  fIdx.close()
+  return len(d)
+
+def indexRecords(bam, bamFile, d):
+  '''
+  Generate (read, flag, seq, qual, barcode) of BAM records
+    with barcodes in d, via the barcode index (built first,
+    if missing or older than the BAM). Records are read
+    in file order.
+  '''
+  idxFile = bamFile + '.cbi'
+  if not os.path.isfile(idxFile) or not os.path.isfile(bamFile + '.cbo') \
+      or os.path.getmtime(idxFile) < os.path.getmtime(bamFile):
+    start = time.time()
+    num = buildIndex(bam, bamFile)
+    sys.stderr.write('Barcode index built: %d barcodes (%.1fs)\n' \
+      % (num, time.time() - start))
+
+  # collect offsets of records with given barcodes
+  offs = array.array('l')
+  fOff = open(bamFile + '.cbo', 'rb')
+  f = open(idxFile, 'rU')
+  for line in f:
+    spl = line.rstrip().split('\t')
+    if spl[0] in d:
+      fOff.seek(int(spl[1]) * offs.itemsize)
+      offs.fromfile(fOff, int(spl[2]))
+  f.close()
+  fOff.close()
+
+  for off in sorted(offs):
+    bam.seek(off)
+    yield bamRecord(next(bam))
+
 def loadBarcodes(filename):
   '''Load barcodes from a given file.'''
   d = dict()
@@ -47,51 +148,180 @@ def loadBarcodes(filename):
   f.close()
   return d
 
+def loadGroups(filename):
+  '''Load barcode -> group table (tab- or comma-delimited).'''
+  d = dict()
+  f = open(filename, 'rU')
+  for line in f:
+    spl = line.rstrip().replace(',', '\t').split('\t')
+    if len(spl) > 1:
+      d[spl[0].split('-')[0]] = spl[1]
+  f.close()
+  return d
+
+class FastqPool:
+  '''
+  FastqPool: buffered fastq writers, one per group
+    ('<prefix><group>.fastq'), keeping at most maxOpen
+    files open (least recently used is closed first).
+  '''
+  def __init__(self, prefix, maxOpen):
+    self.prefix = prefix
+    self.maxOpen = maxOpen
+    self.buf = dict()    # group -> records awaiting write
+    self.size = dict()   # group -> bytes awaiting write
+    self.files = collections.OrderedDict()  # open files, LRU first
+    self.started = set() # groups whose files have been created
+
+  def write(self, group, rec):
+    if group not in self.buf:
+      self.buf[group] = []
+      self.size[group] = 0
+    self.buf[group].append(rec)
+    self.size[group] += len(rec)
+    if self.size[group] >= BUFSIZE:
+      self.flush(group)
+
+  def flush(self, group):
+    if group in self.files:
+      f = self.files.pop(group)
+    else:
+      if len(self.files) >= self.maxOpen:
+        self.files.popitem(last=False)[1].close()
+      mode = 'a' if group in self.started else 'w'
+      f = open(self.prefix + group + '.fastq', mode)
+      self.started.add(group)
+    self.files[group] = f  # now most recently used
+    f.write(''.join(self.buf[group]))
+    self.buf[group] = []
+    self.size[group] = 0
+
+  def close(self):
+    for group in self.buf:
+      if self.buf[group]:
+        self.flush(group)
+    for f in self.files.values():
+      f.close()
+    self.files.clear()
+
 def main():
   '''Main.'''
   # check CL args
   args = sys.argv[1:]
-  if len(args) < 2:
-    sys.stderr.write('Usage: samtools view <BAM> | ')
-    sys.stderr.write('python %s <barcode.csv> <FASTQ>\n' % sys.argv[0])
+  groups = False   # write one FASTQ per group of barcodes
+  bamFile = None   # BAM to read directly (instead of stdin)
+  index = False    # use barcode index of BAM
+  grouped = False  # input grouped by read name (-n or @HD header)
+  while args and args[0] in ['-g', '-b', '-i', '-n']:
+    if args[0] == '-b' and len(args) > 1:
+      bamFile = args[1]
+      args = args[2:]
+    else:
+      groups = groups or args[0] == '-g'
+      index = index or args[0] == '-i'
+      grouped = grouped or args[0] == '-n'
+      args = args[1:]
+  if len(args) < 2 or (index and not bamFile):
+    sys.stderr.write('Usage: samtools view -h <BAM> | ')
+    sys.stderr.write('python %s [-n] <barcode.csv> <FASTQ>\n' % sys.argv[0])
+    sys.stderr.write('   or: samtools view -h <BAM> | ')
+    sys.stderr.write('python %s [-n] -g <groups> <prefix> [<maxOpen>]\n' \
+      % sys.argv[0])
+    sys.stderr.write('   or: python %s [-n] [-g] -b <BAM> [-i] ...\n' \
+      % sys.argv[0])
+    sys.stderr.write('  -n          Input is grouped by read name ' \
+      + '(also set by @HD SO:queryname/GO:query)\n')
+    sys.stderr.write('  -b <BAM>    Read BAM directly (requires pysam)\n')
+    sys.stderr.write('  -i          Use barcode index of BAM ' \
+      + '(built if missing: <BAM>.cbi, <BAM>.cbo)\n')
+    sys.stderr.write('  <groups>    Table of barcode -> group ' \
+      + '(one FASTQ written per group)\n')
+    sys.stderr.write('  <prefix>    Prefix of output FASTQs ' \
+      + '(\'<prefix><group>.fastq\')\n')
+    sys.stderr.write('  <maxOpen>   Max. output files open at once ' \
+      + '(def. %d)\n' % MAXOPEN)
     sys.exit(-1)
 
   # load barcodes
-  d = loadBarcodes(args[0])
+  if groups:
+    d = loadGroups(args[0])
+    maxOpen = MAXOPEN
+    if len(args) > 2:
+      maxOpen = int(args[2])
+    fOut = FastqPool(args[1], maxOpen)
+  else:
+    d = loadBarcodes(args[0])
+    fOut = open(args[1], 'w')
   sys.stderr.write('Barcodes loaded: ' + str(len(d)) + '\n')
 
-  # parse SAM, write output
-  count = 0
-  p = dict()  # for reads already printed
-  f = sys.stdin
-  fOut = open(args[1], 'w')
-  for line in f:
-    if line[0] == '@': continue
-    spl = line.rstrip().split('\t')
+  # check header for grouping by read name
+  if bamFile:
+    if pysam == None:
+      sys.stderr.write('Error! pysam is required to read BAM files\n')
+      sys.exit(-1)
+    f = pysam.AlignmentFile(bamFile, 'rb')
+    header = f.header
+    if hasattr(header, 'to_dict'):
+      header = header.to_dict()
+    hd = header.get('HD', {})
+    if hd.get('SO') == 'queryname' or hd.get('GO') == 'query':
+      grouped = True
+    if index:
+      recs = indexRecords(f, bamFile, d)
+    else:
+      recs = bamRecords(f)
+  else:
+    f = sys.stdin
+    line = f.readline()
+    while line and line[0] == '@':
+      if line[:3] == '@HD' and ('\tSO:queryname' in line \
+          or '\tGO:query' in line):
+        grouped = True
+      line = f.readline()
+    recs = samRecords(itertools.chain([line] if line else [], f))
 
-    # retrieve barcode
-    barcode = getTag('CB', spl[11:])
+  # parse SAM/BAM, write output
+  count = 0
+  prev = None      # last read printed (grouped input)
+  p = set()        # hashes of reads printed (ungrouped input)
+  for name, flag, seq, qual, barcode in recs:
+    # check if barcode is in dict
     if not barcode:
       continue
     barcode = barcode.split('-')[0]
-
-    # check if barcode is in dict
     if barcode in d:
       # check if read has been printed already
-      if spl[0] in p:
-        continue
-      p[spl[0]] = 1
+      if grouped:
+        if name == prev:
+          continue
+        prev = name
+      else:
+        h = hash(name)
+        if h in p:
+          continue
+        p.add(h)
 
       # print fastq record
-      fOut.write('@' + spl[0] + '\n')
-      if int(spl[1]) & 0x10:
-        fOut.write(revComp(spl[9]) + '\n+\n' + spl[10][::-1] + '\n')
+      if flag & 0x10:
+        rec = '@' + name + '\n' + revComp(seq) + '\n+\n' \
+          + qual[::-1] + '\n'
+      else:
+        rec = '@' + name + '\n' + seq + '\n+\n' + qual + '\n'
+      if groups:
+        fOut.write(d[barcode], rec)
       else:
-        fOut.write(spl[9] + '\n+\n' + spl[10] + '\n')
+        fOut.write(rec)
       count += 1
 
   fOut.close()
+  if f != sys.stdin:
+    f.close()
   sys.stderr.write('Reads written: ' + str(count) + '\n')
+  if grouped:
+    sys.stderr.write('  (input grouped by read name: no dedup set)\n')
+  else:
+    sys.stderr.write('  (dedup set: %d reads, %.1f MB)\n' % (len(p), \
+      (sys.getsizeof(p) + len(p) * sys.getsizeof(sys.maxint)) / 1048576.0))
 
 if __name__ == '__main__':
   main()
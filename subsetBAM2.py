@@ -6,22 +6,34 @@
 #   to hg19 (better than mm10)
 
 import sys
+import string
+import os
+import itertools
+import multiprocessing
+import shutil
+import Queue
+try:
+  import pysam
+except ImportError:
+  pysam = None
+
+# complements of DNA (IUPAC) codes, for revComp()
+DNA = 'ACGTRYKMSWBDHVNacgtrykmswbdhvn'
+COMP = string.maketrans(DNA, 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn')
+NONDNA = ''.join([chr(i) for i in xrange(256) if chr(i) not in DNA])
+
+BATCH = 10000  # SAM records per batch sent to a worker
+WAIT = 1       # seconds between checks for failed workers
 
 def revComp(dna):
   '''
-  Reverse-complement the given DNA sequence.
+  Reverse-complement the given DNA sequence
+    (IUPAC codes, upper or lower case).
   '''
-  rc = ''
-  for nuc in dna[::-1]:
-    comp = ''
-    if nuc == 'A': comp = 'T'
-    elif nuc == 'C': comp = 'G'
-    elif nuc == 'G': comp = 'C'
-    elif nuc == 'T': comp = 'A'
-    elif nuc == 'N': comp = 'N'
-    else:
+  rc = dna[::-1].translate(COMP, NONDNA)
+  if len(rc) != len(dna):
+    for nuc in dna.translate(None, DNA):
       print 'Error! Unknown nucleotide: %s' % nuc
-    rc += comp
   return rc
 
 def getTag(tag, lis):
@@ -47,77 +59,277 @@ def loadBarcodes(filename):
   f.close()
   return d
 
+def samRecords(lines):
+  '''
+  Generate (read, flag, ref, seq, qual, AS) from SAM records.
+  '''
+  for line in lines:
+    if line[0] == '@': continue
+    spl = line.rstrip().split('\t')
+    aScore = getTag('AS', spl[11:])
+    yield spl[0], int(spl[1]), spl[2], spl[9], spl[10], \
+      int(aScore) if aScore else None
+
+def bamRecords(bam):
+  '''
+  Generate (read, flag, ref, seq, qual, AS) from BAM records,
+    taking fields and AS tag from the binary records.
+  '''
+  for r in bam.fetch(until_eof=True):
+    qual = r.query_qualities
+    yield r.query_name, r.flag, r.reference_name, \
+      r.query_sequence or '*', \
+      pysam.qualities_to_qualitystring(qual) if qual != None else '*', \
+      r.get_tag('AS') if r.has_tag('AS') else None
+
+def bestHit(rec, gen, best, read):
+  '''
+  Update a read's best alignment score and saved read
+    (seq, qual, reversed) with a new alignment. The read
+    is saved only if its best alignment is to 'gen'.
+  '''
+  if best == None or rec[5] > best:
+    # better AS (or not seen before)
+    best = rec[5]
+    read = None
+    if rec[2][:len(gen)] == gen:
+      read = (rec[3], rec[4], rec[1] & 0x10)
+  elif rec[5] == best and rec[2][:len(gen)] == gen:
+    # equal AS
+    read = (rec[3], rec[4], rec[1] & 0x10)
+  return best, read
+
+def writeRead(fOut, name, read):
+  '''
+  Write a fastq record (in original orientation).
+  '''
+  if read[2]:
+    fOut.write('@' + name + '\n' + revComp(read[0]) + '\n+\n' \
+      + read[1][::-1] + '\n')
+  else:
+    fOut.write('@' + name + '\n' + read[0] + '\n+\n' + read[1] + '\n')
+
+def processSAM(recs, gen, grouped, fOut):
+  '''
+  Save reads whose AS's are best and alns are to 'gen';
+    write them to fOut. If the input is grouped by read
+    name, each read is written as soon as its alignments
+    end, and nothing else is kept.
+  '''
+  score = dict()  # dict of alignment scores
+  reads = dict()  # dict of reads (seq/qual/reversed)
+  name = None     # current read (grouped input)
+  best = read = None
+  count = 0
+  for rec in recs:
+    if rec[1] & 0x4: continue
+
+    # check alignment score
+    if rec[5] == None:
+      sys.stderr.write('missing AS: ' + rec[0] + '\n')
+      continue
+
+    if grouped:
+      # new read: write previous one
+      if rec[0] != name:
+        if read:
+          writeRead(fOut, name, read)
+          count += 1
+        name = rec[0]
+        best = read = None
+      best, read = bestHit(rec, gen, best, read)
+
+    else:
+      best, read = bestHit(rec, gen, score.get(rec[0]), reads.get(rec[0]))
+      score[rec[0]] = best
+      if read:
+        reads[rec[0]] = read
+      elif rec[0] in reads:
+        # better aln not to 'gen': delete
+        del reads[rec[0]]
+
+  # print remaining fastq records
+  if grouped:
+    if read:
+      writeRead(fOut, name, read)
+      count += 1
+  else:
+    for r in reads:
+      writeRead(fOut, r, reads[r])
+      count += 1
+  return count
+
+def runWorker(q, res, gen, grouped, outFile, bam):
+  '''
+  Process batches of SAM lines (or parsed BAM records) from
+    a queue (until None), writing a part of the output.
+  '''
+  fOut = open(outFile, 'w')
+  recs = itertools.chain.from_iterable(iter(q.get, None))
+  if not bam:
+    recs = samRecords(recs)
+  res.put(processSAM(recs, gen, grouped, fOut))
+  fOut.close()
+
+def checkWorkers(workers):
+  '''
+  Exit with an error if any worker process has failed.
+  '''
+  for w in workers:
+    if w.exitcode:
+      sys.stderr.write('Error! Worker process failed\n')
+      sys.exit(-1)
+
+def putChecked(q, item, workers):
+  '''
+  Put item on a (bounded) queue, checking periodically
+    that no worker has failed (and stopped reading).
+  '''
+  while True:
+    try:
+      q.put(item, True, WAIT)
+      return
+    except Queue.Full:
+      checkWorkers(workers)
+
+def getChecked(q, workers):
+  '''
+  Get an item from a queue, checking periodically that
+    no worker has failed (and will never put it).
+  '''
+  while True:
+    try:
+      return q.get(True, WAIT)
+    except Queue.Empty:
+      checkWorkers(workers)
+
+def processParallel(lines, gen, grouped, fOut, outFile, procs, bam):
+  '''
+  Split SAM lines (or parsed BAM records) among worker
+    processes by hash of read name (so each read's alignments
+    stay together, in order). Concatenate the workers' outputs.
+  '''
+  queues = [multiprocessing.Queue(4) for i in xrange(procs)]
+  res = multiprocessing.Queue()
+  parts = ['%s.%d' % (outFile, i) for i in xrange(procs)]
+  workers = [multiprocessing.Process(target=runWorker, \
+    args=(queues[i], res, gen, grouped, parts[i], bam)) \
+    for i in xrange(procs)]
+  done = False
+  try:
+    for w in workers:
+      w.start()
+
+    # send records in batches
+    batches = [[] for i in xrange(procs)]
+    for line in lines:
+      if bam:
+        i = hash(line[0]) % procs
+      else:
+        if line[0] == '@': continue
+        i = hash(line[:line.find('\t')]) % procs
+      batches[i].append(line)
+      if len(batches[i]) == BATCH:
+        putChecked(queues[i], batches[i], workers)
+        batches[i] = []
+    for i in xrange(procs):
+      putChecked(queues[i], batches[i], workers)
+      putChecked(queues[i], None, workers)
+
+    count = sum([getChecked(res, workers) for w in workers])
+    for w in workers:
+      w.join()
+    checkWorkers(workers)
+    for part in parts:
+      f = open(part, 'r')
+      shutil.copyfileobj(f, fOut)
+      f.close()
+    done = True
+  finally:
+    if not done:
+      # stop remaining workers, drain their unread batches
+      for w in workers:
+        if w.is_alive():
+          w.terminate()
+          w.join()
+      for q in queues:
+        try:
+          while True:
+            q.get(True, 0.1)
+        except Queue.Empty:
+          pass
+    for part in parts:
+      if os.path.exists(part):
+        os.remove(part)
+  return count
+
 def main():
   '''Main.'''
   # check CL args
   args = sys.argv[1:]
+  grouped = False  # input grouped by read name
+  procs = 1        # number of worker processes
+  bamFile = None   # BAM to read directly (instead of stdin)
+  while args and args[0] in ['-n', '-p', '-b']:
+    if args[0] == '-n':
+      grouped = True
+      args = args[1:]
+    elif len(args) > 1:
+      if args[0] == '-p':
+        procs = int(args[1])
+      else:
+        bamFile = args[1]
+      args = args[2:]
+    else:
+      args = []
   if len(args) < 2:
     sys.stderr.write('Usage: samtools view <BAM> | ')
-    sys.stderr.write('python %s hg19 <FASTQ>\n' % sys.argv[0])
+    sys.stderr.write('python %s [-n] [-p <int>] hg19 <FASTQ>\n' % sys.argv[0])
+    sys.stderr.write('   or: python %s [-n] [-p <int>] ' % sys.argv[0] \
+      + '-b <BAM> hg19 <FASTQ>\n')
+    sys.stderr.write('  -n         Input is grouped by read name ' \
+      + '(also set by @HD SO:queryname/GO:query)\n')
+    sys.stderr.write('  -p <int>   Number of worker processes (def. 1)\n')
+    sys.stderr.write('  -b <BAM>   Read BAM directly (requires pysam)\n')
     sys.exit(-1)
 
   # load name of genome of interest
   gen = args[0]
 
-  # parse SAM, save reads whose AS's are best and alns are to 'gen'
-  score = dict()  # dict of alignment scores
-  reads = dict()  # dict of reads (seq/qual)
-  f = sys.stdin
-  for line in f:
-    if line[0] == '@': continue
-    spl = line.rstrip().split('\t')
-    flag = int(spl[1])
-    if flag & 0x4: continue
+  # check header for grouping by read name
+  if bamFile:
+    if pysam == None:
+      sys.stderr.write('Error! pysam is required to read BAM files\n')
+      sys.exit(-1)
+    f = pysam.AlignmentFile(bamFile, 'rb')
+    header = f.header
+    if hasattr(header, 'to_dict'):
+      header = header.to_dict()
+    hd = header.get('HD', {})
+    if hd.get('SO') == 'queryname' or hd.get('GO') == 'query':
+      grouped = True
+    lines = bamRecords(f)
+  else:
+    f = sys.stdin
+    line = f.readline()
+    while line and line[0] == '@':
+      if line[:3] == '@HD' and ('\tSO:queryname' in line \
+          or '\tGO:query' in line):
+        grouped = True
+      line = f.readline()
+    lines = itertools.chain([line] if line else [], f)
 
-    # retrieve alignment score
-    aScore = getTag('AS', spl[11:])
-    if not aScore:
-      sys.stderr.write('missing AS: ' + spl[0] + '\n')
-      continue
-    aScore = int(aScore)
-
-    # check scores dict
-    if spl[0] in score:
-
-      if aScore > score[spl[0]]:
-        # better AS
-        score[spl[0]] = aScore
-        if spl[2][:len(gen)] == gen:
-          # save read
-          if flag & 0x10:
-            reads[spl[0]] = (revComp(spl[9]), spl[10][::-1])
-          else:
-            reads[spl[0]] = (spl[9], spl[10])
-        elif spl[0] in reads:
-          # better aln not to 'gen': delete
-          del reads[spl[0]]
-
-      elif aScore == score[spl[0]]:
-        # equal AS
-        if spl[2][:len(gen)] == gen:
-          # save read
-          if flag & 0x10:
-            reads[spl[0]] = (revComp(spl[9]), spl[10][::-1])
-          else:
-            reads[spl[0]] = (spl[9], spl[10])
-
-    else:
-      # not seen before: save AS
-      score[spl[0]] = aScore
-      if spl[2][:len(gen)] == gen:
-        if flag & 0x10:
-          reads[spl[0]] = (revComp(spl[9]), spl[10][::-1])
-        else:
-          reads[spl[0]] = (spl[9], spl[10])
-
-  f.close()
-
-  # print fastq
-  count = 0
+  # parse SAM/BAM, print fastq of reads whose AS's are best
+  #   and alns are to 'gen'
   fOut = open(args[1], 'w')
-  for r in reads:
-    fOut.write('@' + r + '\n' + reads[r][0] + '\n+\n' + reads[r][1] + '\n')
-    count += 1
+  if procs > 1:
+    count = processParallel(lines, gen, grouped, fOut, args[1], procs, \
+      bamFile != None)
+  else:
+    if not bamFile:
+      lines = samRecords(lines)
+    count = processSAM(lines, gen, grouped, fOut)
+  f.close()
 
   fOut.close()
   sys.stderr.write('Reads written: ' + str(count) + '\n')
@@ -5,6 +5,15 @@
 
 import sys
 import gzip
+import os
+import shutil
+import tempfile
+import array
+import multiprocessing
+
+BATCH = 10000     # output records written at once
+MAXWAIT = 1e7     # max. seconds to wait for a worker (keeps get()
+                  #   interruptible)
 
 def openRead(filename):
   '''
@@ -40,64 +49,230 @@ def openWrite(filename):
     sys.exit(-1)
   return f
 
-def main():
-  args = sys.argv[1:]
-  if len(args) < 4:
-    sys.stderr.write('Usage: python updateTaxID2.py  <mergedIDs>  ' \
-      + '<deletedIDs>  <out>  [<in>]+\n')
-    sys.exit(-1)
-
-  # load merged taxIDs to dict
-  d = dict()
-  f = openRead(args[0])
+def loadIDs(mergedFile, deletedFile):
+  '''
+  Load merged and deleted taxIDs. Merges are followed
+    to their final targets (through later merges, and to
+    '0' for deleted taxIDs), on an array indexed by taxID.
+    TaxIDs on a cycle of merges are left as one step, and
+    chains entering a cycle stop at its first taxID.
+    Return dict of old -> final taxID.
+  '''
+  # load merged taxIDs (one step)
+  merged = dict()
+  f = openRead(mergedFile)
   for line in f:
     spl = line.rstrip().split('|')
-    if len(spl) < 2:
+    try:
+      merged[int(spl[0])] = int(spl[1])
+    except (IndexError, ValueError):
       sys.stderr.write('Error! Poorly formatted record in merged file\n')
       sys.exit(-1)
-    d[spl[0].strip()] = spl[1].strip()
   if f != sys.stdin:
     f.close()
 
-  # load deleted taxIDs to dict
-  f2 = openRead(args[1])
-  for line in f2:
+  # load deleted taxIDs
+  deleted = []
+  f = openRead(deletedFile)
+  for line in f:
     spl = line.rstrip().split('|')
-    d[spl[0].strip()] = '0'  # assign deleted to tax ID '0'
+    try:
+      deleted.append(int(spl[0]))
+    except ValueError:
+      sys.stderr.write('Error! Poorly formatted record in deleted file\n')
+      sys.exit(-1)
   if f != sys.stdin:
-    f2.close()
+    f.close()
+
+  # resolve merges: new[taxID] is final taxID (-1 if unchanged)
+  num = max(merged.keys() + merged.values() + deleted + [0]) + 1
+  new = array.array('i', [-1]) * num
+  for tax in deleted:
+    new[tax] = 0  # assign deleted to tax ID '0'
+  # find merge cycles (left as one step; chains stop at them)
+  cycle = set()  # taxIDs on a cycle of merges
+  done = set()
+  for tax in merged:
+    path = []    # chain of merges from tax
+    pos = dict() # taxID -> index in path
+    t = tax
+    while t in merged and new[t] == -1 and t not in done:
+      if t in pos:
+        cyc = path[pos[t]:]
+        sys.stderr.write('Warning! Cycle of merged taxIDs at %d\n' \
+          % min(cyc))
+        cycle.update(cyc)
+        break
+      pos[t] = len(path)
+      path.append(t)
+      t = merged[t]
+    done.update(path)
+  for t in cycle:
+    new[t] = merged[t]
 
-  # open output file
+  chains = 0  # taxIDs updated by more than one step
+  for tax in merged:
+    path = []    # chain of merges from tax
+    t = tax
+    while new[t] == -1 and t in merged:
+      path.append(t)
+      t = merged[t]
+    final = t if new[t] == -1 or t in cycle else new[t]
+    for p in path:
+      new[p] = final
+    if path and final != merged[tax]:
+      chains += 1
+  if chains:
+    sys.stderr.write('Merged taxIDs updated through chains: %d\n' % chains)
+
+  return dict((str(tax), str(new[tax])) for tax in merged.keys() + deleted)
+
+def updateFile(fIn, fOut, d):
+  '''
+  Update the tax IDs of an accession2taxid file, writing
+    (accession.version, taxid) records. Only the columns
+    up to the last one needed are split off each line.
+  '''
+  # parse header
+  accIdx = taxIdx = -1
+  spl = fIn.readline().rstrip().split('\t')
+  try:
+    accIdx = spl.index('accession.version')
+    taxIdx = spl.index('taxid')
+  except ValueError:
+    sys.stderr.write('Error! Cannot find header value '
+      + '(\'accession.version\' or \'taxid\')\n')
+    sys.exit(-1)
+  last = max(accIdx, taxIdx)
+
+  # parse input file, produce output
   merge = printed = 0
-  fOut = openWrite(args[2])
+  out = []
+  for line in fIn:
+    spl = line.split('\t', last + 1)
+    if len(spl) == last + 1:
+      spl[last] = spl[last].rstrip()  # last column of line
+    tax = spl[taxIdx]
+    if tax in d:
+      tax = d[tax]
+      merge += 1
+    out.append(spl[accIdx] + '\t' + tax + '\n')
+    if len(out) == BATCH:
+      fOut.write(''.join(out))
+      printed += len(out)
+      out = []
+  fOut.write(''.join(out))
+  printed += len(out)
+  return printed, merge
+
+def initWorker(d):
+  '''
+  Save the updated taxIDs for a worker process.
+  '''
+  global ids
+  ids = d
 
-  # parse input files, write output on the fly
-  for arg in args[3:]:
-    fIn = openRead(arg)
+def runFile(inFile, partFile, compress):
+  '''
+  Update an input file (in a worker process), writing
+    to a part of the output. Return counts (None on error).
+  '''
+  try:
+    fIn = openRead(inFile)
+    if compress:
+      fOut = gzip.open(partFile, 'wb')
+    else:
+      fOut = open(partFile, 'w')
+    res = updateFile(fIn, fOut, ids)
+    fIn.close()
+    fOut.close()
+  except (SystemExit, IOError):
+    res = None
+  return res
 
-    # parse header
-    accIdx = taxIdx = -1
-    spl = fIn.readline().rstrip().split('\t')
-    try:
-      accIdx = spl.index('accession.version')
-      taxIdx = spl.index('taxid')
-    except ValueError:
-      sys.stderr.write('Error! Cannot find header value '
-        + '(\'accession.version\' or \'taxid\')')
+def updateParallel(files, outFile, d, procs):
+  '''
+  Update input files in a pool of worker processes, each
+    file written to a temp part of the output (compressed
+    in the worker, if outFile is gzip). Join the parts
+    (gzip members can be concatenated) in input order.
+  '''
+  for arg in files:
+    if not os.access(arg, os.R_OK):
+      sys.stderr.write('Error! Cannot open %s for reading\n' % arg)
       sys.exit(-1)
+  compress = outFile[-3:] == '.gz'
+  parts = []
+  try:
+    for arg in files:
+      fd, part = tempfile.mkstemp(prefix=os.path.basename(outFile) + '.', \
+        dir=os.path.dirname(os.path.abspath(outFile)))
+      os.close(fd)
+      parts.append(part)
+
+    pool = multiprocessing.Pool(min(procs, len(files)), initWorker, (d,))
+    jobs = [pool.apply_async(runFile, (arg, part, compress)) \
+      for arg, part in zip(files, parts)]
+    res = [job.get(MAXWAIT) for job in jobs]
+    pool.close()
+    pool.join()
+    if None in res:
+      sys.stderr.write('Error! Cannot process %s\n' \
+        % files[res.index(None)])
+      sys.exit(-1)
+
+    # join parts
+    if outFile == '-':
+      fOut = sys.stdout
+    else:
+      try:
+        fOut = open(outFile, 'wb')
+      except IOError:
+        sys.stderr.write('Error! Cannot open %s for writing\n' % outFile)
+        sys.exit(-1)
+    for part in parts:
+      f = open(part, 'rb')
+      shutil.copyfileobj(f, fOut)
+      f.close()
+    fOut.close()
+
+  finally:
+    for part in parts:
+      if os.path.exists(part):
+        os.remove(part)
+  return sum([r[0] for r in res]), sum([r[1] for r in res])
+
+def main():
+  args = sys.argv[1:]
+  procs = 1  # number of worker processes
+  if len(args) > 1 and args[0] == '-p':
+    procs = int(args[1])
+    args = args[2:]
+  if len(args) < 4:
+    sys.stderr.write('Usage: python updateTaxID2.py  [-p <int>]  ' \
+      + '<mergedIDs>  <deletedIDs>  <out>  [<in>]+\n')
+    sys.stderr.write('  -p <int>   Number of input files processed ' \
+      + 'at once (def. 1)\n')
+    sys.exit(-1)
+
+  # load merged/deleted taxIDs (resolved to final targets)
+  d = loadIDs(args[0], args[1])
+
+  # parse input files, write output
+  if procs > 1 and len(args) > 4 and '-' not in args[3:]:
+    printed, merge = updateParallel(args[3:], args[2], d, procs)
+  else:
+    merge = printed = 0
+    fOut = openWrite(args[2])
+    for arg in args[3:]:
+      fIn = openRead(arg)
+      count, num = updateFile(fIn, fOut, d)
+      printed += count
+      merge += num
+      if fIn != sys.stdin:
+        fIn.close()
+    fOut.close()
 
-    # parse input file, produce output
-    for line in fIn:
-      spl = line.rstrip().split('\t')
-      if spl[taxIdx] in d:
-        spl[taxIdx] = d[spl[taxIdx]]
-        merge += 1
-      fOut.write(spl[accIdx] + '\t' + spl[taxIdx] + '\n')
-      printed += 1
-    if fIn != sys.stdin:
-      fIn.close()
-
-  fOut.close()
   sys.stderr.write('Records written: %d\n' % printed)
   sys.stderr.write('  Updated: %d\n' % merge)
 